@@ -1,350 +1,2904 @@
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import Response, JSONResponse, HTMLResponse
+from fastapi import FastAPI, HTTPException, Query, Header
+from fastapi.responses import Response, JSONResponse, HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
+from starlette.datastructures import Headers, MutableHeaders
 import httpx
 import asyncio
 import re
 import time
-from urllib.parse import urlparse, urljoin, quote, unquote
-from datetime import datetime
+from urllib.parse import urlparse, urlunparse, urljoin, quote, unquote
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import json
+import mimetypes
 import random
 import os
 import hashlib
 import base64
+import copy
+from contextlib import contextmanager, asynccontextmanager, AsyncExitStack
+from contextvars import ContextVar
+import heapq
+import itertools
+import posixpath
+import sqlite3
+import tempfile
+import threading
+import zipfile
+import zlib
+import sys
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
+from html.parser import HTMLParser
+from dataclasses import dataclass
+from enum import Enum
+from functools import partial, cached_property
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import brotli  # (also lets httpx decode br responses)
+    BROTLI_AVAILABLE = True
+except ImportError:
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+def _parse_strategy_weights(value):
+    weights = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, weight = item.split('=', 1)
+            weights[name.strip()] = float(weight)
+    return weights
+
+# Settings: every one can be overridden with the environment variable of the same name
+
+# Logging
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# Upstream connection pool
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "15"))
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "1") == "1" and HTTP2_AVAILABLE
+
+# Probe scheduling
+PROBE_CONCURRENCY = int(os.environ.get("PROBE_CONCURRENCY", "16"))
+PROBE_PER_HOST = int(os.environ.get("PROBE_PER_HOST", "6"))
+
+# Per-host rate limiting and circuit breaker
+HOST_MAX_RATE = float(os.environ.get("HOST_MAX_RATE", "50"))  # Requests per second
+HOST_MIN_RATE = float(os.environ.get("HOST_MIN_RATE", "0.5"))
+HOST_RATE_STEP = float(os.environ.get("HOST_RATE_STEP", "2"))  # Additive increase per success
+HOST_SLOW_FACTOR = float(os.environ.get("HOST_SLOW_FACTOR", "3"))  # Latency vs baseline that counts as slow
+HOST_SLOW_LATENCY = float(os.environ.get("HOST_SLOW_LATENCY", "0.5"))  # Answers faster than this are never slow
+HOST_DECREASE_INTERVAL = float(os.environ.get("HOST_DECREASE_INTERVAL", "1"))  # At most one rate cut per interval
+HOST_MAX_RETRY_AFTER = float(os.environ.get("HOST_MAX_RETRY_AFTER", "10"))
+CIRCUIT_FAILURES = int(os.environ.get("CIRCUIT_FAILURES", "5"))
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", "30"))
+
+# Per-call budget defaults (0 = unlimited)
+CALL_MAX_REQUESTS = int(os.environ.get("CALL_MAX_REQUESTS", "0"))
+CALL_DEADLINE_MS = int(os.environ.get("CALL_DEADLINE_MS", "0"))
+
+# Body reads
+PROBE_SNIFF_BYTES = int(os.environ.get("PROBE_SNIFF_BYTES", "4096"))
+PROBE_MAX_BODY_BYTES = int(os.environ.get("PROBE_MAX_BODY_BYTES", str(10 * 1024 * 1024)))
+MIN_CONTENT_BYTES = int(os.environ.get("MIN_CONTENT_BYTES", "10"))
+
+# Soft-404 detection
+SOFT404_PROBES = int(os.environ.get("SOFT404_PROBES", "3"))  # Random paths fetched per host; 0 disables
+SOFT404_TTL = int(os.environ.get("SOFT404_TTL", "3600"))
+SOFT404_MAX_HOSTS = int(os.environ.get("SOFT404_MAX_HOSTS", "1024"))
+SOFT404_LENGTH_BUCKET = int(os.environ.get("SOFT404_LENGTH_BUCKET", "512"))
+
+# Light probes (HEAD / Range)
+PROBE_METHODS_TTL = int(os.environ.get("PROBE_METHODS_TTL", "3600"))
+PROBE_METHODS_MAX_HOSTS = int(os.environ.get("PROBE_METHODS_MAX_HOSTS", "1024"))
+HEAD_SAMPLE = int(os.environ.get("HEAD_SAMPLE", "8"))  # HEADs judged before deciding whether they pay off
+
+# Recovery strategies: relative cost of each one's probes (lower is scheduled first),
+# e.g. STRATEGY_WEIGHTS=direct=1,brute_force=2
+STRATEGY_WEIGHTS = {
+    'direct': 1,
+    'download': 1,
+    'traversal': 2,
+    'brute_force': 4,
+}
+STRATEGY_WEIGHTS.update(_parse_strategy_weights(os.environ.get("STRATEGY_WEIGHTS", "")))
+# Seconds a strategy's hit waits for the strategies ranked above it
+STRATEGY_HIT_GRACE = float(os.environ.get("STRATEGY_HIT_GRACE", "3"))
+
+# Candidate planning and the learned path index
+WORDLISTS_DIR = os.environ.get("WORDLISTS_DIR", os.path.join(os.path.dirname(__file__), "..", "wordlists"))
+PLAN_LOOKAHEAD = int(os.environ.get("PLAN_LOOKAHEAD", "256"))  # Candidates reordered by learned templates at once
+PATH_INDEX_PATH = os.environ.get("PATH_INDEX_PATH", os.path.join(tempfile.gettempdir(), "infinityfree-path-index.json"))
+PATH_INDEX_MAX_DOMAINS = int(os.environ.get("PATH_INDEX_MAX_DOMAINS", "2000"))
+
+# Result cache
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")  # memory | sqlite
+CACHE_PATH = os.environ.get("CACHE_PATH", os.path.join(tempfile.gettempdir(), "infinityfree-cache.sqlite3"))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "4096"))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", "3600"))
+CACHE_NEGATIVE_TTL = float(os.environ.get("CACHE_NEGATIVE_TTL", "600"))
+CACHE_REVALIDATE_AFTER = float(os.environ.get("CACHE_REVALIDATE_AFTER", "60"))  # Serve unchecked for this long
+CACHE_MAX_BODY_BYTES = int(os.environ.get("CACHE_MAX_BODY_BYTES", str(2 * 1024 * 1024)))  # Larger files aren't cached
+
+# Header negotiation
+HEADER_SAMPLE_URLS = int(os.environ.get("HEADER_SAMPLE_URLS", "2"))
+HEADER_NEGOTIATION_TTL = float(os.environ.get("HEADER_NEGOTIATION_TTL", "3600"))
+HEADER_NEGOTIATION_MAX_HOSTS = int(os.environ.get("HEADER_NEGOTIATION_MAX_HOSTS", "1024"))
+
+# Directory listing harvest
+LISTING_MAX_DEPTH = int(os.environ.get("LISTING_MAX_DEPTH", "2"))         # Subdirectory levels followed below a root
+LISTING_MAX_REQUESTS = int(os.environ.get("LISTING_MAX_REQUESTS", "20"))  # Listing pages fetched per crawl
+LISTING_MAX_ENTRIES = int(os.environ.get("LISTING_MAX_ENTRIES", "5000"))  # Entries kept per listing
+
+# Request tracing
+TRACE_MAX_STORED = int(os.environ.get("TRACE_MAX_STORED", "100"))
+
+# Response compression
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "1") == "1"
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", "4"))
+
+# Background jobs
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "64"))
+JOB_TTL = float(os.environ.get("JOB_TTL", "900"))
+JOB_PROGRESS_INTERVAL = float(os.environ.get("JOB_PROGRESS_INTERVAL", "0.5"))
+
+# Batch recovery
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", "500"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+
+class JSONLogFormatter(logging.Formatter):
+    """One JSON object per line; fields passed with extra= become top-level keys"""
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class LogQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread: the stock
+    prepare() formats on the caller and drops exc_info, which would put the
+    traceback inside "message" instead of "exc"
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()  # Arguments may change before the listener runs
+        record.args = None
+        return record
+
+def configure_logging(level=LOG_LEVEL):
+    """
+    App logger that only enqueues records; a listener thread formats them
+    as JSON and writes stdout, so the event loop never blocks on logging
+    """
+    logger = logging.getLogger("infinityfree")
+    logger.setLevel(level)
+    logger.propagate = False
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JSONLogFormatter())
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(LogQueueHandler(log_queue))
+    return logger
+
+log = configure_logging()
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+    kind = 'counter'
+    
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+    
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, dict(zip(self.labels, key)), value
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by labels"""
+    kind = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [bucket counts..., sum, count]
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+    
+    def samples(self):
+        for key, state in self.values.items():
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, state):
+                yield f"{self.name}_bucket", {**labels, 'le': str(bound)}, count
+            yield f"{self.name}_bucket", {**labels, 'le': '+Inf'}, state[-1]
+            yield f"{self.name}_sum", labels, state[-2]
+            yield f"{self.name}_count", labels, state[-1]
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+    kind = 'gauge'
+    
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+    
+    def samples(self):
+        yield self.name, {}, self.read()
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRegistry:
+    """In-process metrics rendered in the Prometheus text format"""
+    def __init__(self):
+        self.metrics = []
+    
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+    
+    def histogram(self, name, help, labels=(), buckets=Histogram.BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+    
+    def gauge(self, name, help, read):
+        return self._register(Gauge(name, help, read))
+    
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    pairs = ','.join(f'{label}="{_label_value(v)}"' for label, v in labels.items())
+                    name = f"{name}{{{pairs}}}"
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+strategy_probes = metrics.counter('recovery_probes_total', 'Candidates probed, by strategy', ['strategy'])
+template_probes = metrics.counter('recovery_template_probes_total', 'Candidates probed, by path template', ['template'])
+template_hits = metrics.counter('recovery_template_hits_total', 'Candidates that recovered the file, by path template', ['template'])
+strategy_duration = metrics.histogram('recovery_strategy_duration_seconds', 'Time spent per strategy, by outcome', ['strategy', 'outcome'])
+upstream_latency = metrics.histogram('upstream_response_seconds', 'Time until upstream response headers, by status class', ['status'])
+upstream_errors = metrics.counter('upstream_errors_total', 'Upstream requests that failed without a response', ['error'])
+upstream_bytes = metrics.counter('upstream_bytes_total', 'Response body bytes read from upstream hosts')
+cache_lookups = metrics.counter('cache_lookups_total', 'Result cache lookups, by entry kind and result', ['kind', 'result'])
+
+# Sent on every probe, header sets included; httpx decodes these while streaming
+UPSTREAM_ACCEPT_ENCODING = "br, gzip, deflate" if BROTLI_AVAILABLE else "gzip, deflate"
+
+class HTTPClientPool:
+    """
+    One application-scoped httpx.AsyncClient shared by every probe
+    so connections to the same host are kept alive and reused
+    """
+    def __init__(self):
+        self._client = None
+        self.transport = None  # Custom transport (benchmarks / mock hosts)
+    
+    def _create_client(self):
+        limits = httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        return httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=limits,
+            headers={'Accept-Encoding': UPSTREAM_ACCEPT_ENCODING},
+            http2=HTTP2_ENABLED and self.transport is None,
+            transport=self.transport,
+        )
+    
+    @property
+    def client(self):
+        # Created lazily as well, for runtimes that skip lifespan events
+        if self._client is None or self._client.is_closed:
+            self._client = self._create_client()
+        return self._client
+    
+    async def start(self):
+        return self.client
+    
+    async def close(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+http_pool = HTTPClientPool()
+
+# Responses that mean the host is overloaded rather than the path missing
+HOST_OVERLOAD_STATUSES = {429, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    """Raised instead of probing a host whose circuit breaker is open"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after  # Seconds until the host is tried again
+
+class DirectoryCircuitOpenError(Exception):
+    """
+    Raised instead of probing a directory that keeps failing on a host that
+    otherwise answers; probes treat it as a miss
+    """
+
+def host_unavailable(e: CircuitOpenError):
+    """503 for a call refused because the upstream host's circuit is open"""
+    retry_after = max(1, round(e.retry_after or 1))
+    return HTTPException(status_code=503, detail=f"Upstream host unavailable: {e}",
+                         headers={'Retry-After': str(retry_after)})
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date)"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+class HostLimiter:
+    """
+    Token bucket for one host whose rate adapts to how the host answers:
+    successes at normal latency raise it step by step, overload statuses,
+    transport errors and slow answers halve it. Retry-After pauses the
+    host, and a run of consecutive failures opens the circuit so probes
+    fail fast until a single trial request succeeds after the cooldown
+    
+    Timeouts and connection errors are also counted per directory: a run
+    confined to one directory (a path that hangs on a host answering
+    everywhere else) only makes that directory fail fast
+    """
+    def __init__(self, host, max_rate=HOST_MAX_RATE, min_rate=HOST_MIN_RATE):
+        self.host = host
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.baseline = None  # Fastest smoothed latency seen, in seconds
+        self.latency = None
+        self.failures = 0
+        self.decreased_at = 0.0
+        self.state = 'closed'
+        self.open_until = 0.0
+        self.trial = False
+        self.failed_directories = set()  # Directories in the current run of failures
+        self.directory_failures = {}  # directory -> consecutive transport failures
+        self.directory_open_until = {}  # directory -> when its probes stop failing fast
+    
+    def _refill(self, now):
+        self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def _check_circuit(self, now):
+        if self.state == 'open':
+            if now < self.open_until:
+                raise CircuitOpenError(f"circuit open for {self.host} ({self.open_until - now:.1f}s left)",
+                                       retry_after=self.open_until - now)
+            self.state = 'half_open'
+            self.trial = False
+        if self.state == 'half_open':
+            if self.trial:
+                raise CircuitOpenError(f"circuit half-open for {self.host}, trial request in flight", retry_after=1)
+            self.trial = True
+    
+    def _check_directory(self, directory, now):
+        until = self.directory_open_until.get(directory)
+        if until is None:
+            return
+        if now < until:
+            raise DirectoryCircuitOpenError(f"{self.host}{directory.rstrip('/')}/ keeps failing ({until - now:.1f}s left)")
+        del self.directory_open_until[directory]
+        self.directory_failures.pop(directory, None)
+    
+    async def acquire(self, directory=None):
+        """
+        Wait for a token, or raise CircuitOpenError if the host is failing
+        (DirectoryCircuitOpenError if only `directory` is)
+        """
+        now = time.monotonic()
+        self._check_directory(directory, now)
+        self._check_circuit(now)
+        while True:
+            now = time.monotonic()
+            if self.state == 'open':
+                raise CircuitOpenError(f"circuit open for {self.host}", retry_after=self.open_until - now)
+            if self.paused_until > now:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def release(self):
+        # A half-open trial that ended without an outcome (cancelled, or
+        # rejected before sending) lets the next probe try instead
+        if self.state == 'half_open':
+            self.trial = False
+    
+    def _success(self, directory=None):
+        self.failures = 0
+        self.failed_directories.clear()
+        self.directory_failures.pop(directory, None)
+        self.state = 'closed'
+        self.trial = False
+    
+    def _decrease(self):
+        # Probes in flight when the host slows down all report it; cut once
+        now = time.monotonic()
+        if now - self.decreased_at >= HOST_DECREASE_INTERVAL:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.decreased_at = now
+    
+    def _failure(self, directory=None):
+        self.failures += 1
+        if directory is not None:
+            self.failed_directories.add(directory)
+            failures = self.directory_failures[directory] = self.directory_failures.get(directory, 0) + 1
+            if failures >= CIRCUIT_FAILURES:
+                self.directory_open_until[directory] = time.monotonic() + CIRCUIT_COOLDOWN
+            if self.state != 'half_open' and len(self.failed_directories) < 2:
+                return  # One bad directory says nothing about the host
+        self._decrease()
+        if self.state == 'half_open' or self.failures >= CIRCUIT_FAILURES:
+            self.state = 'open'
+            self.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+            self.trial = False
+            log.warning("circuit opened", extra={'host': self.host, 'failures': self.failures})
+    
+    def record_response(self, status_code, elapsed, retry_after=None, directory=None):
+        """Feed back one response's status, time to headers and Retry-After"""
+        wait = parse_retry_after(retry_after) if status_code in HOST_OVERLOAD_STATUSES else None
+        if wait:
+            if wait > HOST_MAX_RETRY_AFTER:
+                # Longer than we're willing to hold workers; fail fast instead
+                self.state = 'open'
+                self.open_until = time.monotonic() + wait
+                self.trial = False
+            else:
+                self.paused_until = max(self.paused_until, time.monotonic() + wait)
+        if status_code in HOST_OVERLOAD_STATUSES:
+            self._failure()
+            return
+        self._success(directory)
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        if self.latency > max(self.baseline * HOST_SLOW_FACTOR, HOST_SLOW_LATENCY):
+            self._decrease()
+        else:
+            self.rate = min(self.max_rate, self.rate + HOST_RATE_STEP)
+    
+    def record_error(self, directory=None):
+        """Feed back a timeout or connection error on a request into `directory`"""
+        self._failure(directory)
+    
+    def snapshot(self):
+        return {
+            'rate': round(self.rate, 2),
+            'state': self.state,
+            'failures': self.failures,
+            'failing_directories': sorted(directory for directory, until in self.directory_open_until.items()
+                                          if until > time.monotonic()),
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+        }
+
+class BudgetExhausted(Exception):
+    """The API call's request or time budget is spent"""
+
+class CallBudget:
+    """
+    Upstream requests and wall time one API call may spend
+    A probe is charged when it is sent, so shared and deduplicated probes
+    are free; probes sent close to the deadline only get the time left.
+    A soft-404 calibration is charged to the call that sets it off
+    """
+    def __init__(self, max_requests=None, deadline_ms=None):
+        self.max_requests = max_requests or None
+        self.deadline_ms = deadline_ms or None
+        self.deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms else None
+        self.requests = 0
+        self.exhausted = None  # 'requests' | 'deadline' once spent
+    
+    def remaining(self):
+        """Seconds left before the deadline, or None without one"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+    
+    def check(self):
+        """Raise BudgetExhausted once the deadline has passed or every request is spent"""
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.exhausted = 'deadline'
+            raise BudgetExhausted(f"deadline of {self.deadline_ms} ms reached")
+        if self.max_requests is not None and self.requests >= self.max_requests:
+            self.exhausted = 'requests'
+            raise BudgetExhausted(f"request budget of {self.max_requests} spent")
+    
+    def charge(self):
+        self.check()
+        self.requests += 1
+    
+    def timeout(self, timeout):
+        remaining = self.remaining()
+        return timeout if remaining is None else min(timeout, remaining)
+    
+    def to_dict(self):
+        return {
+            'max_requests': self.max_requests,
+            'deadline_ms': self.deadline_ms,
+            'requests': self.requests,
+            'exhausted': self.exhausted,
+        }
+
+# Budget of the API call the current task is probing for (if any)
+current_call_budget = ContextVar('current_call_budget', default=None)
+
+@contextmanager
+def call_budget(max_requests=None, deadline_ms=None):
+    """Run the block under a CallBudget; unset limits fall back to the CALL_* defaults"""
+    budget = CallBudget(max_requests or CALL_MAX_REQUESTS, deadline_ms or CALL_DEADLINE_MS)
+    token = current_call_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        current_call_budget.reset(token)
+
+class ProbeScheduler:
+    """
+    Runs probes with bounded fan-out, at most `per_host` requests in
+    flight per host, paced by each host's adaptive HostLimiter
+    """
+    def __init__(self, concurrency=PROBE_CONCURRENCY, per_host=PROBE_PER_HOST):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self._loop = None
+        self._host_slots = {}
+        self.limiters = {}
+    
+    def _bind_loop(self):
+        # asyncio primitives belong to one event loop; start fresh on a new one
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._host_slots = {}
+    
+    def limiter(self, host):
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = self.limiters[host] = HostLimiter(host)
+        return limiter
+    
+    @asynccontextmanager
+    async def host_slot(self, host, directory=None):
+        """
+        Hold one of the host's request slots for the duration of a request
+        into `directory`; yields the host's limiter so the caller can report
+        the outcome
+        """
+        self._bind_loop()
+        limiter = self.limiter(host)
+        semaphore = self._host_slots.get(host)
+        if semaphore is None:
+            semaphore = self._host_slots[host] = asyncio.Semaphore(self.per_host)
+        async with semaphore:
+            await limiter.acquire(directory)
+            try:
+                yield limiter
+            finally:
+                limiter.release()
+    
+    async def _run_workers(self, worker, fan_out):
+        fan_out = max(1, fan_out or self.concurrency)
+        tasks = [asyncio.create_task(worker()) for _ in range(fan_out)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                if result is not None:
+                    return result
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def first_success(self, candidates, probe, fan_out=None):
+        """
+        Run probe(candidate) over candidates in order and return the first
+        non-None result; probes still running are cancelled
+        Candidates are pulled lazily and no more are taken once the call's
+        budget is spent
+        """
+        iterator = iter(candidates)
+        
+        async def worker():
+            for candidate in iterator:
+                try:
+                    result = await probe(candidate)
+                except asyncio.CancelledError:
+                    raise
+                except BudgetExhausted:
+                    return None
+                except CircuitOpenError:
+                    raise  # The host is down, not the candidate missing
+                except Exception:
+                    continue
+                if result is not None:
+                    return result
+            return None
+        
+        return await self._run_workers(worker, fan_out)
+    
+    async def as_completed(self, candidates, probe, fan_out=None):
+        """Yield probe(candidate) results in completion order as each finishes"""
+        iterator = iter(candidates)
+        finished = asyncio.Queue()
+        worker_done = object()
+        errors = []
+        
+        async def worker():
+            try:
+                for candidate in iterator:
+                    finished.put_nowait(await probe(candidate))
+            except BudgetExhausted:
+                pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                finished.put_nowait(worker_done)
+        
+        tasks = [asyncio.create_task(worker()) for _ in range(max(1, fan_out or self.concurrency))]
+        running = len(tasks)
+        try:
+            while running:
+                item = await finished.get()
+                if item is worker_done:
+                    if errors:
+                        raise errors[0]
+                    running -= 1
+                    continue
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def map(self, candidates, probe, fan_out=None):
+        """
+        Run probe(candidate) over all candidates, results in input order
+        Once the call's budget is spent no more candidates are taken; the
+        results stop there, with None for probes it cut short
+        """
+        results = []
+        iterator = enumerate(candidates)
+        
+        async def worker():
+            for index, candidate in iterator:
+                results.extend([None] * (index + 1 - len(results)))
+                try:
+                    results[index] = await probe(candidate)
+                except BudgetExhausted:
+                    return None
+            return None
+        
+        await self._run_workers(worker, fan_out)
+        return results
+
+probe_scheduler = ProbeScheduler()
+metrics.gauge(
+    'upstream_hosts_circuit_open', 'Hosts whose circuit breaker is open or half-open',
+    lambda: sum(limiter.state != 'closed' for limiter in probe_scheduler.limiters.values()),
+)
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one in-flight computation
+    The computation runs as its own task and is cancelled only when every
+    caller waiting on it has been cancelled
+    """
+    def __init__(self):
+        self._flights = {}  # key -> [task, waiters]
+        self.started = 0
+        self.shared = 0
+    
+    async def do(self, key, compute):
+        flight = self._flights.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(compute())
+            flight = self._flights[key] = [task, 0]
+            task.add_done_callback(lambda _, key=key, flight=flight: self._forget(key, flight))
+            self.started += 1
+        else:
+            self.shared += 1
+        
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if flight[1] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            flight[1] -= 1
+    
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+# Identical probe URLs requested by concurrent recoveries share one request
+probe_flights = SingleFlight()
+
+class ProbeBudget:
+    """
+    Concurrency budget shared by all strategies of one recovery
+    Waiting probes are admitted lowest priority value first, FIFO within
+    the same priority
+    """
+    def __init__(self, size=PROBE_CONCURRENCY):
+        self._free = size
+        self._waiters = []
+        self._sequence = itertools.count()
+    
+    def share(self, weight, stats=None, name=None):
+        return BudgetShare(self, weight, stats, name)
+    
+    async def acquire(self, priority=0):
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Granted and cancelled in the same tick: hand the slot on
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+    
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._free += 1
+
+class BudgetShare:
+    """
+    One strategy's access to a ProbeBudget; each probe costs `weight`
+    virtual time, so a weight-1 strategy is admitted about four times
+    as often as a weight-4 strategy while both are waiting
+    """
+    def __init__(self, budget, weight, stats=None, name=None):
+        self.budget = budget
+        self.weight = weight
+        self.stats = stats  # Live 'probes' count for progress reports
+        self.name = name  # Strategy name, for traces
+        self.issued = 0
+    
+    @asynccontextmanager
+    async def slot(self):
+        priority = self.issued * self.weight
+        self.issued += 1
+        if self.stats is not None:
+            self.stats['probes'] = self.issued
+        await self.budget.acquire(priority)
+        try:
+            yield
+        finally:
+            self.budget.release()
+
+# Budget share of the strategy the current task is running for (if any)
+current_budget_share = ContextVar('current_budget_share', default=None)
+
+class Verdict(str, Enum):
+    REAL = 'real'
+    EMPTY = 'empty'
+    PROTECTION = 'protection'          # aes.js challenge page
+    TRAP = 'trap'                      # "trap for bots" / "content loading" page
+    DIRECTORY_LISTING = 'directory_listing'
+    ERROR_PAGE = 'error_page'
+    SOFT_404 = 'soft_404'              # the host's answer for paths that don't exist
+    UNKNOWN = 'unknown'                # only headers were read (a HEAD the budget left no GET for)
+
+class ContentClassifier:
+    """
+    Decides whether a body is the real file or one of the pages served in
+    its place, with a single precompiled case-insensitive pass over the bytes
+    An error-like <title> only marks an error page on an error status: a 200
+    titled "Error handling guide" is content (the host's 200 error page is
+    caught by its soft-404 fingerprint instead)
+    """
+    PATTERN = re.compile(
+        rb'(?P<protection>aes\.js)'
+        rb'|(?P<trap>trap for bots|content loading)'
+        rb'|(?P<directory_listing><title>\s*index of\b|\[to parent directory\])'
+        rb'|(?P<error_page><title>\s*(?:40[0-9]|50[0-9]|not found|forbidden|error)\b)',
+        re.IGNORECASE,
+    )
+    # Highest precedence first
+    PRECEDENCE = (Verdict.PROTECTION, Verdict.TRAP, Verdict.ERROR_PAGE, Verdict.DIRECTORY_LISTING)
+    
+    def scan(self, body: bytes):
+        """Set of page kinds whose markers occur in body"""
+        found = set()
+        for match in self.PATTERN.finditer(body):
+            found.add(Verdict(match.lastgroup))
+            if Verdict.PROTECTION in found:
+                break
+        return found
+    
+    def classify(self, body: bytes, status_code=200, found=None):
+        if found is None:
+            found = self.scan(body)
+        for verdict in self.PRECEDENCE:
+            if verdict in found and (verdict != Verdict.ERROR_PAGE or status_code >= 400):
+                return verdict
+        if status_code >= 400:
+            return Verdict.ERROR_PAGE
+        if len(body) <= MIN_CONTENT_BYTES:
+            return Verdict.EMPTY
+        return Verdict.REAL
+
+content_classifier = ContentClassifier()
+
+class ProbeResponse:
+    """
+    Status, headers and the (possibly partial) body of one probe
+    The body is decoded and classified at most once
+    """
+    claimed = False  # Some caller is forwarding this response
+    capped = False   # Body cut off at the probe's max_bytes; the file continues past it
+    upstream = None  # Still-open httpx response when the rest was left unread
+    rest = None      # Iterator over the unread rest of the body
+    host_slot = None  # The host request slot a still-open response keeps taken
+    kept_by = None    # OpenStreams of the recovery holding it
+    request_headers = None
+    
+    def __init__(self, response, body: bytes, truncated=False, verdict=None):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = response.url
+        self.method = response.request.method
+        self.encoding = response.encoding or 'utf-8'
+        self.body = body
+        self.truncated = truncated  # Stopped at the size cap or on a protection page
+        if verdict is not None:
+            self.verdict = verdict
+    
+    @cached_property
+    def text(self):
+        return self.body.decode(self.encoding, errors='replace')
+    
+    @cached_property
+    def markers(self):
+        return content_classifier.scan(self.body)
+    
+    @cached_property
+    def verdict(self):
+        return content_classifier.classify(self.body, self.status_code, self.markers)
+    
+    @property
+    def is_real(self):
+        return self.status_code in (200, 206) and self.verdict == Verdict.REAL
+    
+    @property
+    def validators(self):
+        """Upstream ETag / Last-Modified, for revalidating a cached copy later"""
+        return {
+            name: self.headers[header]
+            for name, header in (('etag', 'etag'), ('last_modified', 'last-modified'))
+            if header in self.headers
+        }
+    
+    async def aiter_body(self):
+        """The body read so far followed by the unread rest, if any"""
+        yield self.body
+        if self.rest is not None:
+            async for chunk in self.rest:
+                upstream_bytes.inc(len(chunk))
+                yield chunk
+    
+    async def aclose(self):
+        if self.upstream is not None:
+            await self.upstream.aclose()
+            self.upstream = None
+        if self.host_slot is not None:
+            await self.host_slot.aclose()
+            self.host_slot = None
+    
+    @property
+    def content_length(self):
+        """
+        Upstream size: Content-Range's total for a ranged read, else
+        Content-Length when the body was not fully read (or not sent, for
+        HEAD); None if that is unknown (it counts compressed bytes when encoded)
+        """
+        if self.status_code == 206:
+            return content_range_total(self.headers)
+        if not self.truncated and self.method != 'HEAD':
+            return len(self.body)
+        if (self.headers.get('content-length', '').isdigit() and
+                self.headers.get('content-encoding', 'identity') == 'identity'):
+            return int(self.headers['content-length'])
+        return None
+
+def content_range_total(headers):
+    """Full size from a "Content-Range: bytes 0-4095/12345" header, or None"""
+    match = re.match(r'bytes\s+\d+-\d+/(\d+)', headers.get('content-range', ''))
+    return int(match.group(1)) if match else None
+
+async def _read_body(chunks, status_code, abort_on_marker, max_bytes, keep_open=False, soft_404=None):
+    """
+    Read from the chunk iterator until it ends, hits `max_bytes`, or the
+    first PROBE_SNIFF_BYTES show a protection page (abort_on_marker), the
+    host's soft-404 page (`soft_404(head, length)` is true) or real content
+    (keep_open); returns (body, truncated, verdict, kept_open)
+    """
+    parts = []
+    size = 0
+    sniffed = False
+    async for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if (abort_on_marker or keep_open or soft_404) and not sniffed and size >= PROBE_SNIFF_BYTES:
+            sniffed = True
+            head = b''.join(parts)
+            parts = [head]
+            verdict = content_classifier.classify(head, status_code)
+            if abort_on_marker and verdict in (Verdict.PROTECTION, Verdict.TRAP):
+                return head, True, verdict, False
+            if soft_404 is not None and verdict == Verdict.REAL and soft_404(head, None):
+                return head, True, Verdict.SOFT_404, False
+            if keep_open and verdict == Verdict.REAL:
+                return head, True, verdict, True
+        if size >= max_bytes:
+            return b''.join(parts)[:max_bytes], True, None, False
+    
+    body = b''.join(parts)
+    if soft_404 is not None and not sniffed:
+        if content_classifier.classify(body, status_code) == Verdict.REAL and soft_404(body, len(body)):
+            return body, False, Verdict.SOFT_404, False
+    return body, False, None, False
+
+class OpenStreams:
+    """
+    Real-content responses that the probes of one streamed recovery kept
+    open, keyed by candidate URL, so the winner can be forwarded without
+    buffering it; everything not taken is closed
+    """
+    def __init__(self):
+        self._kept = {}
+        self.closed = False
+    
+    async def keep(self, url: str, probe_response):
+        probe_response.kept_by = self
+        if self.closed:
+            # A shared probe that outlived the recovery it was started for
+            await probe_response.aclose()
+            return
+        previous = self._kept.pop(url, None)
+        if previous is not None:
+            await previous.aclose()
+        self._kept[url] = probe_response
+    
+    def __contains__(self, url):
+        return url in self._kept
+    
+    def take(self, url: str):
+        return self._kept.pop(url, None)
+    
+    async def discard(self, url: str):
+        """Close the response kept for `url`, e.g. once its candidate is passed over"""
+        probe_response = self._kept.pop(url, None)
+        if probe_response is not None:
+            await probe_response.aclose()
+    
+    async def aclose(self):
+        self.closed = True
+        kept, self._kept = self._kept, {}
+        for probe_response in kept.values():
+            await probe_response.aclose()
+
+# Set while a recovery streams its result; probes then keep real content open
+current_open_streams = ContextVar('current_open_streams', default=None)
+
+# httpcore trace events (without the http11./http2./connection. prefix) -> timeline field
+TRACE_PHASES = {
+    'connect_tcp': 'connect_ms',
+    'start_tls': 'tls_ms',
+    'receive_response_headers': 'wait_ms',
+}
+
+class ProbeTrace:
+    """
+    Timeline of every probe one request made: candidate URL, strategy,
+    header set, start/end offsets, time queued for a slot, connect/TLS/
+    server wait from httpcore's trace events, TTFB, bytes read and verdict
+    Candidates skipped on a cached miss are listed with `cached_miss`
+    """
+    def __init__(self, url: str, kind: str):
+        self.id = base64.urlsafe_b64encode(os.urandom(9)).decode()
+        self.url = url
+        self.kind = kind
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+        self.elapsed_ms = None
+        self.report = None
+        self.probes = []
+    
+    def offset(self):
+        """Milliseconds since the trace started"""
+        return round((time.perf_counter() - self._started) * 1000, 2)
+    
+    def _strategy(self):
+        share = current_budget_share.get()
+        return share.name if share is not None and share.name else self.kind
+    
+    def begin(self, url: str, headers=None):
+        entry = {'url': url, 'strategy': self._strategy(), 'headers': headers, 'start_ms': self.offset()}
+        self.probes.append(entry)
+        return entry
+    
+    def skipped(self, url: str, headers, reason: str):
+        entry = self.begin(url, headers)
+        entry['end_ms'] = entry['start_ms']
+        entry['cached_miss'] = reason
+    
+    def hook(self, entry):
+        """httpx `trace` extension callback recording connection phases into `entry`"""
+        phase_started = {}
+        
+        async def trace(event_name, info):
+            name, _, stage = event_name.rpartition('.')
+            field = TRACE_PHASES.get(name.rpartition('.')[2])
+            if field is None:
+                return
+            if stage == 'started':
+                phase_started[field] = self.offset()
+            elif field in phase_started:
+                entry[field] = round(self.offset() - phase_started.pop(field), 2)
+        
+        return trace
+    
+    def finish(self, entry, probe_response=None, error=None):
+        entry['end_ms'] = self.offset()
+        if probe_response is not None:
+            entry['status'] = probe_response.status_code
+            entry['bytes'] = len(probe_response.body)
+            entry['truncated'] = probe_response.truncated
+            entry['verdict'] = probe_response.verdict.value
+        if error is not None:
+            entry['error'] = 'cancelled' if isinstance(error, asyncio.CancelledError) else f"{type(error).__name__}: {error}"
+    
+    def close(self, report=None):
+        self.elapsed_ms = self.offset()
+        self.report = report
+    
+    def summary(self):
+        """Per-strategy totals: probes, cached misses, time queued for a slot, time on the wire and bytes"""
+        strategies = {}
+        for entry in self.probes:
+            totals = strategies.setdefault(entry['strategy'], {
+                'probes': 0, 'cached_misses': 0, 'queued_ms': 0, 'busy_ms': 0, 'bytes': 0,
+            })
+            if 'cached_miss' in entry:
+                totals['cached_misses'] += 1
+                continue
+            duration = entry.get('end_ms', self.offset()) - entry['start_ms']
+            queued = entry.get('queued_ms', duration)  # Cancelled before getting a slot
+            totals['probes'] += 1
+            totals['queued_ms'] = round(totals['queued_ms'] + queued, 2)
+            totals['busy_ms'] = round(totals['busy_ms'] + duration - queued, 2)
+            totals['bytes'] += entry.get('bytes', 0)
+        return strategies
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'url': self.url,
+            'started_at': self.started_at.isoformat(),
+            'elapsed_ms': self.elapsed_ms,
+            'report': self.report,
+            'summary': self.summary(),
+            'probes': self.probes,
+        }
+
+class TraceStore:
+    """The most recent finished traces, for GET /api/traces/{id}"""
+    def __init__(self, max_entries=TRACE_MAX_STORED):
+        self.max_entries = max_entries
+        self._traces = OrderedDict()
+    
+    def add(self, trace):
+        self._traces[trace.id] = trace
+        while len(self._traces) > self.max_entries:
+            self._traces.popitem(last=False)
+    
+    def get(self, trace_id: str):
+        return self._traces.get(trace_id)
+
+trace_store = TraceStore()
+
+# Trace of the request the current task is probing for (if traced)
+current_trace = ContextVar('current_trace', default=None)
+
+# Requests sent for the candidate the current task is probing (set by RecoveryPlan.tracked)
+current_probe_sends = ContextVar('current_probe_sends', default=None)
+
+soft_404_rejections = metrics.counter(
+    'upstream_soft_404_total', 'Probe responses rejected for matching the host soft-404 fingerprint'
+)
+
+class Soft404Detector:
+    """
+    Learns what a host answers for paths that cannot exist
+    Each host is calibrated once by fetching a few random paths; every 200
+    with real-looking content is fingerprinted by status, length bucket,
+    content type/encoding and a hash of its first PROBE_SNIFF_BYTES with
+    the requested path and digits blanked out (pages that echo the URL or
+    a timestamp still match). A candidate whose headers and first chunk
+    match a fingerprint is a miss, however real its body looks.
+    Hosts that answer missing paths with a 404 get no fingerprints.
+    Calibration follows redirects the way the probe it serves does, so a
+    host that redirects missing paths to its landing page is fingerprinted
+    by the page it lands on.
+    """
+    SHAPES = ('/{0}.html', '/{0}/{1}.php', '/{0}/')
+    
+    def __init__(self, probes=SOFT404_PROBES, ttl=SOFT404_TTL, max_hosts=SOFT404_MAX_HOSTS):
+        self.probes = probes
+        self.ttl = ttl
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()  # (host, follow_redirects) -> (fingerprints, calibrated_at)
+        self._calibrating = {}       # (host, follow_redirects) -> calibration task
+    
+    @staticmethod
+    def _normalize(head: bytes, path: str):
+        for variant in sorted({path, unquote(path), quote(path)}, key=len, reverse=True):
+            if len(variant) > 1:
+                head = head.replace(variant.encode(), b'')
+        return re.sub(rb'\d+', b'0', head)
+    
+    def fingerprint(self, status_code, headers, head: bytes, path: str, length=None):
+        """`length` is the full body size if known; otherwise an identity Content-Length is used"""
+        encoding = headers.get('content-encoding', 'identity')
+        if status_code == 206:  # Ranged read of the same page
+            status_code, length = 200, content_range_total(headers)
+        if length is None and encoding == 'identity' and headers.get('content-length', '').isdigit():
+            length = int(headers['content-length'])
+        return {
+            'status': status_code,
+            'length_bucket': None if length is None else length // SOFT404_LENGTH_BUCKET,
+            'headers': (headers.get('content-type', '').split(';')[0].strip().lower(), encoding),
+            'hash': hashlib.blake2b(self._normalize(head[:PROBE_SNIFF_BYTES], path), digest_size=8).hexdigest(),
+        }
+    
+    @staticmethod
+    def _same(fingerprint, known):
+        if (fingerprint['status'], fingerprint['headers'], fingerprint['hash']) != \
+                (known['status'], known['headers'], known['hash']):
+            return False
+        if fingerprint['length_bucket'] is None or known['length_bucket'] is None:
+            return True
+        # The echoed path changes the length a little, so neighbouring buckets match too
+        return abs(fingerprint['length_bucket'] - known['length_bucket']) <= 1
+    
+    def matcher(self, fingerprints, url: str, response):
+        """Callable (head, length) -> True when the body start matches one of `fingerprints`"""
+        path = urlparse(url).path
+        
+        def matches(head, length=None):
+            fingerprint = self.fingerprint(response.status_code, response.headers, head, path, length)
+            return any(self._same(fingerprint, known) for known in fingerprints)
+        
+        return matches
+    
+    async def fingerprints(self, url: str, follow_redirects=False):
+        """
+        The host's soft-404 fingerprints for probes with the given redirect
+        policy, calibrating it first if needed
+        """
+        if self.probes <= 0:
+            return []
+        parsed = urlparse(url)
+        key = (parsed.netloc, follow_redirects)
+        entry = self._hosts.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            self._hosts.move_to_end(key)
+            return entry[0]
+        task = self._calibrating.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._calibrating[key] = asyncio.create_task(
+                self._calibrate(parsed.scheme, parsed.netloc, follow_redirects))
+            task.add_done_callback(lambda _: self._calibrating.pop(key, None))
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            return []
+    
+    async def _calibrate(self, scheme: str, host: str, follow_redirects=False):
+        # The calibration belongs to the host, not to the request that triggered it,
+        # except that its requests count against that request's call budget
+        current_budget_share.set(None)
+        current_trace.set(None)
+        current_open_streams.set(None)
+        current_probe_sends.set(None)
+        
+        nonces = [os.urandom(8).hex() for _ in range(2)]
+        paths = [shape.format(*nonces) for shape in self.SHAPES[:self.probes]]
+        responses = await asyncio.gather(*(
+            probe_fetch(f"{scheme}://{host}{path}", follow_redirects=follow_redirects, abort_on_marker=False,
+                        max_bytes=PROBE_SNIFF_BYTES, detect_soft_404=False)
+            for path in paths
+        ), return_exceptions=True)
+        answered = [(path, response) for path, response in zip(paths, responses)
+                    if not isinstance(response, BaseException)]
+        fingerprints = []
+        for path, response in answered:
+            # With redirects followed, this is the final response (a landing page)
+            if response.is_real:
+                fingerprint = self.fingerprint(response.status_code, response.headers, response.body, path,
+                                               response.content_length)
+                if fingerprint not in fingerprints:
+                    fingerprints.append(fingerprint)
+        cut_short = any(isinstance(response, BudgetExhausted) for response in responses)
+        # Try again next time if the host didn't answer at all or the budget stopped us
+        if answered and not cut_short:
+            key = (host, follow_redirects)
+            self._hosts[key] = (fingerprints, time.time())
+            self._hosts.move_to_end(key)
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        log.info("soft-404 calibrated", extra={'host': host, 'follow_redirects': follow_redirects,
+                                               'answered': len(answered), 'fingerprints': len(fingerprints)})
+        return fingerprints
+
+soft_404_detector = Soft404Detector()
+
+async def probe_fetch(url: str, headers=None, timeout=HTTP_TIMEOUT, follow_redirects=False,
+                      abort_on_marker=True, max_bytes=PROBE_MAX_BODY_BYTES, detect_soft_404=True, method='GET'):
+    """
+    Streamed GET through the shared client while holding one of the host's
+    slots; reading stops early on a protection marker, on the host's
+    soft-404 page (detect_soft_404) or at `max_bytes`
+    
+    Inside a streamed recovery, a 200 whose first chunk is real content is
+    returned after that chunk with the rest left unread and registered in
+    the recovery's OpenStreams
+    
+    Probes sent are charged to the current call budget (if any); a spent
+    budget raises BudgetExhausted instead of sending
+    """
+    budget = current_call_budget.get()
+    if budget is not None:
+        budget.check()
+        timeout = budget.timeout(timeout)
+    streams = current_open_streams.get()
+    # A traced request makes its own probes so each one lands in its timeline
+    if current_trace.get() is None:
+        key = json.dumps([method, normalize_url(url), headers, follow_redirects, abort_on_marker, max_bytes,
+                          detect_soft_404], sort_keys=True)
+        response = await probe_flights.do(key, partial(
+            _probe_fetch, url, headers, timeout, follow_redirects, abort_on_marker, max_bytes, streams,
+            detect_soft_404, method,
+        ))
+        # Misses and fully read bodies are shared; a response left open for
+        # another recovery to forward holds only its first chunk, so fetch our own
+        if response.rest is None or response.kept_by is streams:
+            return response
+    return await _probe_fetch(url, headers, timeout, follow_redirects, abort_on_marker, max_bytes, streams,
+                              detect_soft_404, method)
+
+async def _probe_fetch(url, headers, timeout, follow_redirects, abort_on_marker, max_bytes, streams,
+                       detect_soft_404=True, method='GET'):
+    # Calibrate before taking any slot: the calibration probes need the host's slots too
+    fingerprints = await soft_404_detector.fingerprints(url, follow_redirects) if detect_soft_404 else None
+    trace = current_trace.get()
+    if trace is None:
+        return await _send_probe(url, headers, timeout, follow_redirects, abort_on_marker, max_bytes, streams,
+                                 fingerprints=fingerprints, method=method)
+    entry = trace.begin(url, headers)
+    if method != 'GET':
+        entry['method'] = method
+    try:
+        probe_response = await _send_probe(
+            url, headers, timeout, follow_redirects, abort_on_marker, max_bytes, streams, trace, entry, fingerprints,
+            method,
+        )
+    except BaseException as e:
+        trace.finish(entry, error=e)
+        raise
+    trace.finish(entry, probe_response)
+    return probe_response
+
+async def _send_probe(url, headers, timeout, follow_redirects, abort_on_marker, max_bytes, streams,
+                      trace=None, entry=None, fingerprints=None, method='GET'):
+    share = current_budget_share.get()
+    async with AsyncExitStack() as stack:
+        if share is not None:
+            await stack.enter_async_context(share.slot())
+        parsed = urlparse(url)
+        directory = posixpath.dirname(parsed.path) or '/'
+        # Separate from the share slot: a response left open keeps its host slot until closed
+        host_slot = await stack.enter_async_context(AsyncExitStack())
+        limiter = await host_slot.enter_async_context(probe_scheduler.host_slot(parsed.netloc, directory))
+        budget = current_call_budget.get()
+        if budget is not None:
+            budget.charge()  # The budget may have run out while waiting for a slot
+            timeout = budget.timeout(timeout)
+        sends = current_probe_sends.get()
+        if sends is not None:
+            sends.append(url)
+        
+        client = http_pool.client
+        extensions = None
+        if entry is not None:
+            entry['queued_ms'] = round(trace.offset() - entry['start_ms'], 2)
+            extensions = {'trace': trace.hook(entry)}
+        request = client.build_request(method, url, headers=headers, timeout=timeout, extensions=extensions)
+        started = time.monotonic()
+        try:
+            response = await client.send(request, stream=True, follow_redirects=follow_redirects)
+        except httpx.TransportError as e:
+            limiter.record_error(directory)
+            upstream_errors.inc(error=type(e).__name__)
+            raise
+        elapsed = time.monotonic() - started
+        limiter.record_response(response.status_code, elapsed, response.headers.get('retry-after'), directory)
+        upstream_latency.observe(elapsed, status=f"{response.status_code // 100}xx")
+        if entry is not None:
+            entry['ttfb_ms'] = round(elapsed * 1000, 2)
+        soft_404 = None
+        if fingerprints and response.status_code in (200, 206):
+            soft_404 = soft_404_detector.matcher(fingerprints, url, response)
+        kept_open = False
+        try:
+            chunks = response.aiter_bytes()
+            try:
+                body, truncated, verdict, kept_open = await _read_body(
+                    chunks, response.status_code, abort_on_marker, max_bytes,
+                    keep_open=streams is not None and response.status_code == 200, soft_404=soft_404,
+                )
+            except httpx.TransportError as e:
+                limiter.record_error(directory)
+                upstream_errors.inc(error=type(e).__name__)
+                raise
+            upstream_bytes.inc(len(body))
+            if verdict == Verdict.SOFT_404:
+                soft_404_rejections.inc()
+            probe_response = ProbeResponse(response, body, truncated, verdict)
+            probe_response.capped = truncated and verdict is None and not kept_open
+            probe_response.request_headers = headers
+            if kept_open:
+                probe_response.upstream = response
+                probe_response.rest = chunks
+                probe_response.host_slot = host_slot.pop_all()
+            if streams is not None and probe_response.is_real:
+                await streams.keep(url, probe_response)
+            return probe_response
+        finally:
+            if not kept_open:
+                await response.aclose()
+
+# HEAD answers meaning the server doesn't do HEAD (rather than that the file is missing)
+HEAD_UNSUPPORTED_STATUSES = {405, 501}
+
+# Sizes must be of the file itself, not of a compressed transfer
+LIGHT_PROBE_HEADERS = {'Accept-Encoding': 'identity'}
+
+class ProbeMethods:
+    """
+    Per-host record of whether HEAD and Range requests work, learned from
+    the first light probes: a 405/501 to HEAD, or a 200 to a ranged GET,
+    turns that method off for the host; unknown counts as supported
+    HEAD is also dropped where most answers still need a body read (hosts
+    that serve a challenge page for everything), as it only adds a request there
+    """
+    def __init__(self, ttl=PROBE_METHODS_TTL, max_hosts=PROBE_METHODS_MAX_HOSTS, head_sample=HEAD_SAMPLE):
+        self.ttl = ttl
+        self.max_hosts = max_hosts
+        self.head_sample = head_sample
+        self._hosts = OrderedDict()  # host -> {'head': bool, 'range': bool, 'head_settled': [settled, total], 'at': learned at}
+    
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None or time.time() - state['at'] > self.ttl:
+            state = self._hosts[host] = {'at': time.time()}
+        self._hosts.move_to_end(host)
+        while len(self._hosts) > self.max_hosts:
+            self._hosts.popitem(last=False)
+        return state
+    
+    def supports(self, host: str, method: str):
+        return self._state(host).get(method, True)
+    
+    def record(self, host: str, method: str, supported: bool):
+        state = self._state(host)
+        if state.get(method) != supported:
+            state[method] = supported
+            log.info("probe method support", extra={'host': host, 'method': method, 'supported': supported})
+    
+    def record_head(self, host: str, settled: bool):
+        """Note whether a HEAD answered the probe by itself"""
+        state = self._state(host)
+        counts = state.setdefault('head_settled', [0, 0])
+        counts[0] += settled
+        counts[1] += 1
+        if counts[1] == self.head_sample:
+            self.record(host, 'head', counts[0] * 2 >= counts[1])
+    
+    def snapshot(self, host: str):
+        state = self._hosts.get(host, {})
+        return {method: state.get(method) for method in ('head', 'range')}
+
+probe_methods = ProbeMethods()
+
+def _needs_body(response):
+    """
+    Whether a HEAD answer leaves the verdict open: only a 200 with a
+    textual type can be a protection, trap, listing or soft-404 page
+    """
+    if response.status_code != 200:
+        return False
+    media_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+    return (not media_type or media_type.startswith('text/') or
+            media_type.endswith(('+xml', '/xml', '/json', '/javascript')))
+
+async def probe_light(url: str, timeout=HTTP_TIMEOUT, follow_redirects=False):
+    """
+    Status, type and size of `url` for as few bytes as possible: a HEAD,
+    then (when that can't settle the verdict) a GET of only the first
+    PROBE_SNIFF_BYTES, ranged where the host honours Range
+    Returns (ProbeResponse, method used: 'head', 'range' or 'get')
+    When the call's budget runs out between the HEAD and the GET, the HEAD
+    answer is returned with an UNKNOWN verdict rather than thrown away
+    """
+    host = urlparse(url).netloc
+    head = None
+    if probe_methods.supports(host, 'head'):
+        response = await probe_fetch(url, headers=LIGHT_PROBE_HEADERS, timeout=timeout,
+                                     follow_redirects=follow_redirects, method='HEAD')
+        if response.status_code in HEAD_UNSUPPORTED_STATUSES:
+            probe_methods.record(host, 'head', False)
+        else:
+            probe_methods.record_head(host, not _needs_body(response))
+            if not _needs_body(response):
+                if response.status_code == 200:
+                    # A HEAD has no body to classify; binary types are taken as the file
+                    length = response.content_length
+                    response.verdict = Verdict.EMPTY if length is not None and length <= MIN_CONTENT_BYTES else Verdict.REAL
+                return response, 'head'
+            head = response
+    
+    headers = dict(LIGHT_PROBE_HEADERS)
+    ranged = probe_methods.supports(host, 'range')
+    if ranged:
+        headers['Range'] = f"bytes=0-{PROBE_SNIFF_BYTES - 1}"
+    try:
+        response = await probe_fetch(url, headers=headers, timeout=timeout, follow_redirects=follow_redirects,
+                                     max_bytes=PROBE_SNIFF_BYTES)
+    except BudgetExhausted:
+        if head is None:
+            raise
+        head.verdict = Verdict.UNKNOWN
+        return head, 'head'
+    if ranged and response.status_code == 206:
+        probe_methods.record(host, 'range', True)
+    elif ranged and response.status_code == 200 and probe_methods.snapshot(host)['range'] is None:
+        # Dynamic pages ignore Range even where static files honour it, so one 206 outweighs any 200s
+        probe_methods.record(host, 'range', False)
+    return response, 'range' if response.status_code == 206 else 'get'
+
+class StrategyRunner:
+    """
+    Races recovery strategies under one ProbeBudget
+    Strategies are ranked in the order given, weights only decide how
+    their probes are scheduled. A hit is accepted once every strategy
+    ranked above it has finished, or after `grace` seconds; the best
+    ranked hit by then wins and the rest are cancelled
+    """
+    def __init__(self, strategies, budget_size=PROBE_CONCURRENCY, grace=STRATEGY_HIT_GRACE):
+        self.strategies = strategies  # [(name, weight, coroutine function)], best ranked first
+        self.budget_size = budget_size
+        self.grace = grace
+    
+    async def run(self, url: str, report=None):
+        if report is None:
+            report = {}
+        budget = ProbeBudget(self.budget_size)
+        report['winner'] = None
+        report['strategies'] = {}
+        started = time.perf_counter()
+        
+        async def run_strategy(name, weight, strategy):
+            timing = report['strategies'][name] = {'weight': weight, 'outcome': 'running', 'probes': 0}
+            current_budget_share.set(budget.share(weight, timing, name))
+            strategy_started = time.perf_counter()
+            try:
+                content, source_url = await strategy(url)
+                timing['outcome'] = 'found' if content else 'miss'
+                return content, source_url
+            except asyncio.CancelledError:
+                timing['outcome'] = 'cancelled'
+                raise
+            except CircuitOpenError as e:
+                # Every strategy probes the same host; the race ends here
+                timing['outcome'] = 'host_unavailable'
+                timing['error'] = str(e)
+                raise
+            except Exception as e:
+                timing['outcome'] = 'error'
+                timing['error'] = str(e)
+                return None, None
+            finally:
+                elapsed = time.perf_counter() - strategy_started
+                timing['elapsed_ms'] = round(elapsed * 1000, 1)
+                strategy_duration.observe(elapsed, strategy=name, outcome=timing['outcome'])
+        
+        tasks = {
+            asyncio.create_task(run_strategy(name, weight, strategy)): name
+            for name, weight, strategy in self.strategies
+        }
+        ranked = list(tasks)
+        hits = {}  # task -> (content, source_url)
+        held_until = None  # Deadline for strategies ranked above a held hit
+        result = (None, None)
+        try:
+            pending = set(tasks)
+            while pending:
+                timeout = None if held_until is None else max(0.0, held_until - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    content, source_url = task.result()
+                    if content:
+                        hits[task] = (content, source_url)
+                if not hits:
+                    continue
+                best = next(task for task in ranked if task in hits)
+                if held_until is None:
+                    held_until = time.monotonic() + self.grace
+                if all(task.done() for task in ranked[:ranked.index(best)]) or time.monotonic() >= held_until:
+                    report['winner'] = tasks[best]
+                    result = hits[best]
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            report['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        
+        return result
+
+@asynccontextmanager
+async def lifespan(app):
+    await http_pool.start()
+    job_manager.start()
+    try:
+        yield
+    finally:
+        await job_manager.close()
+        await http_pool.close()
 
 app = FastAPI(
     title="InfinityFree Direct File Access",
     description="Directly access uploaded files from InfinityFree hosting",
-    version="14.0.0"
+    version="14.0.0",
+    lifespan=lifespan
 )
 
+# Bodies that are event streams or already compressed pass through untouched
+COMPRESS_SKIP_TYPES = ('text/event-stream', 'application/zip', 'application/gzip', 'image/', 'audio/', 'video/')
+
+class StreamCompressor:
+    """Incremental gzip or brotli encoder whose output is flushed per chunk"""
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        else:
+            self._zlib = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    
+    def compress(self, data: bytes):
+        if self.encoding == 'br':
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self):
+        if self.encoding == 'br':
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+def choose_encoding(accept_encoding: str):
+    """Best of br/gzip the client accepts (q > 0), preferring br on ties"""
+    supported = ('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)
+    weights = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        match = re.search(r'q=([0-9.]+)', params)
+        if match:
+            try:
+                q = float(match.group(1))
+            except ValueError:
+                q = 0.0
+        weights[name.strip()] = q
+    best = None
+    for encoding in supported:
+        q = weights.get(encoding, weights.get('*', 0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (encoding, q)
+    return best[0] if best else None
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses with brotli or gzip when the
+    client accepts it. Whole bodies under `minimum_size` are left alone;
+    streamed bodies are compressed chunk by chunk and flushed, so NDJSON
+    results still arrive as they are produced. Event streams, encoded
+    bodies and already-compressed media pass through
+    """
+    def __init__(self, app, minimum_size=COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        encoding = choose_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        
+        start = None
+        compressor = None
+        passthrough = False
+        
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body' or passthrough:
+                return await send(message)
+            
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start['headers'])
+                content_type = headers.get('content-type', '')
+                declared = headers.get('content-length')
+                if (start['status'] in (204, 206, 304) or 'content-encoding' in headers or
+                        content_type.startswith(COMPRESS_SKIP_TYPES)):
+                    passthrough = True
+                elif (not more_body and len(body) < self.minimum_size) or (
+                        declared is not None and declared.isdigit() and int(declared) < self.minimum_size):
+                    headers.add_vary_header('Accept-Encoding')
+                    passthrough = True
+                if passthrough:
+                    await send(start)
+                    return await send(message)
+                
+                compressor = StreamCompressor(encoding)
+                headers['Content-Encoding'] = encoding
+                headers.add_vary_header('Accept-Encoding')
+                if not more_body:
+                    body = compressor.compress(body) + compressor.finish()
+                    headers['Content-Length'] = str(len(body))
+                    await send(start)
+                    return await send({'type': 'http.response.body', 'body': body})
+                del headers['Content-Length']
+                await send(start)
+            
+            data = compressor.compress(body) if body else b''
+            if not more_body:
+                data += compressor.finish()
+            if data or not more_body:
+                await send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+        
+        await self.app(scope, receive, send_compressed)
+
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware)
+
 templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "..", "templates"))
 
-class DirectFileAccessor:
-    def __init__(self):
-        self.cache = {}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def normalize_url(url: str):
+    """
+    Canonical form of a candidate URL: lowercase scheme and host, no
+    default port, no duplicate slashes or dot segments
+    """
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or '').lower()
+    netloc = host
+    if parsed.port is not None and DEFAULT_PORTS.get(scheme) != parsed.port:
+        netloc = f"{host}:{parsed.port}"
+    
+    path = re.sub(r'/{2,}', '/', parsed.path or '/')
+    trailing_slash = path.endswith('/')
+    path = posixpath.normpath(path)
+    if trailing_slash and not path.endswith('/'):
+        path += '/'
     
-    async def get_file_content_directly(self, url: str):
+    return urlunparse((scheme, netloc, path, '', parsed.query, ''))
+
+@dataclass
+class Candidate:
+    url: str
+    strategy: str
+    template: str  # Pattern that produced the URL, e.g. "/htdocs{path}"
+    score: float   # Lower is more likely
+    learned: bool = False  # Template found files on this domain before
+
+class RecoveryPlan:
+    """
+    Candidate URLs for every strategy of one recovery, normalized,
+    ordered by likelihood and deduplicated across strategies
+    Candidates are generated as strategies consume them, so a URL belongs
+    to the first strategy that reaches it. Within a strategy, a window of
+    `lookahead` candidates is kept ordered by score, which is how
+    templates that worked on the domain before move to the front.
+    """
+    def __init__(self, url: str, path_index=None, lookahead=PLAN_LOOKAHEAD):
+        self.url = url
+        self.domain = urlparse(normalize_url(url)).netloc
+        self.path_index = path_index
+        self.lookahead = lookahead
+        self.learned_only = False
+        self.sources = {}  # strategy -> (generate, limit)
+        self.seeded = {}   # strategy -> (candidates found while running, drop(url) or None)
+        self.issued = {}   # strategy -> candidates handed out so far
+        self.by_url = {}
+        self.missed = set()  # URLs probed without success
+        self.found = {}  # URL -> ProbeResponse that returned content
+        self.pages = {}  # directory URL -> ProbeResponse, shared by traversal and the listing harvest
+        self._seen = set()
+        self._page_flights = SingleFlight()
+    
+    def add(self, strategy, generate, limit=None):
+        """`generate()` yields the strategy's candidates, most likely first"""
+        self.sources[strategy] = (generate, limit)
+    
+    def seed(self, strategy, candidates, drop=None):
         """
-        Try to get file content directly without protection
-        InfinityFree stores files in specific directories
+        Put candidates discovered while running (read off a directory
+        listing) ahead of the strategy's generated ones, and skip generated
+        URLs for which drop(url) is true
         """
-        print(f"\n{'='*60}")
-        print(f"Direct File Access for: {url}")
-        print(f"{'='*60}")
-        
-        parsed = urlparse(url)
+        self.seeded[strategy] = (list(candidates), drop)
+    
+    def _ordered(self, candidates):
+        """Candidates with their learned adjustment, reordered within the lookahead window"""
+        window = []
+        sequence = itertools.count()  # Equal scores keep generation order
+        for candidate in candidates:
+            if self.path_index is not None:
+                adjustment = self.path_index.adjustment(self.domain, candidate.template)
+                candidate.score += adjustment
+                candidate.learned = adjustment < 0
+            if self.learned_only and not candidate.learned:
+                continue
+            heapq.heappush(window, (candidate.score, next(sequence), candidate))
+            if len(window) > self.lookahead:
+                yield heapq.heappop(window)[2]
+        while window:
+            yield heapq.heappop(window)[2]
+    
+    def candidates(self, strategy):
+        """Generator over the strategy's candidates: seeded ones, then generated ones"""
+        generate, limit = self.sources.get(strategy, (None, None))
+        seeded, drop = self.seeded.get(strategy, ([], None))
+        generated = self._ordered(generate()) if generate is not None else ()
+        self.issued[strategy] = 0
+        for candidate in itertools.chain(seeded, (
+            candidate for candidate in generated if not (drop and drop(normalize_url(candidate.url)))
+        )):
+            candidate.url = normalize_url(candidate.url)
+            if candidate.url in self._seen:
+                continue
+            self._seen.add(candidate.url)
+            self.by_url.setdefault(candidate.url, candidate)
+            self.issued[strategy] += 1
+            yield candidate
+            if limit is not None and self.issued[strategy] >= limit:
+                return
+    
+    def urls(self, strategy):
+        return (candidate.url for candidate in self.candidates(strategy))
+    
+    def has_learned(self):
+        """Whether any template found files on this domain before"""
+        if self.path_index is None:
+            return False
+        return any(stats[0] for stats in self.path_index.templates(self.domain).values())
+    
+    def learned(self):
+        """
+        View of this plan holding only candidates whose template worked on
+        the domain before; bookkeeping is shared with the full plan
+        """
+        view = RecoveryPlan(self.url, self.path_index, self.lookahead)
+        view.learned_only = True
+        view.sources = self.sources
+        view.by_url = self.by_url
+        view.missed = self.missed
+        view.found = self.found
+        view.pages = self.pages
+        view._page_flights = self._page_flights
+        return view
+    
+    async def directory_page(self, url: str):
+        """
+        The page at directory `url`, fetched once per recovery: traversal's
+        parent-directory candidates and the listing harvest both read it
+        """
+        if url not in self.pages:
+            self.pages[url] = await self._page_flights.do(
+                url, partial(probe_fetch, url, timeout=10, follow_redirects=True))
+        return self.pages[url]
+    
+    def tracked(self, probe):
+        """
+        Wrap a strategy probe so candidates that come back empty are recorded.
+        Only candidates that sent a request upstream count as probed; cached
+        misses and header sets skipped by the negotiator do not
+        """
+        async def tracked_probe(candidate):
+            url = candidate if isinstance(candidate, str) else candidate[0]
+            planned = self.by_url.get(url)
+            sends = []
+            token = current_probe_sends.set(sends)
+            try:
+                result = await probe(candidate)
+            finally:
+                current_probe_sends.reset(token)
+                if planned is not None and sends:
+                    strategy_probes.inc(strategy=planned.strategy)
+                    template_probes.inc(template=planned.template)
+            if result is None:
+                self.missed.add(url)
+                streams = current_open_streams.get()
+                if streams is not None:
+                    await streams.discard(url)  # Don't let a passed-over response hold a host slot
+            elif planned is not None:
+                template_hits.inc(template=planned.template)
+            return result
+        return tracked_probe
+
+class Wordlists:
+    """
+    Word and template files in WORDLISTS_DIR (name.txt), one entry per
+    line, blank lines and '#' comments skipped. Files are streamed on every
+    pass instead of being held, so a large wordlist costs no memory.
+    In a template, @name stands for each word of name.txt in turn (the
+    leftmost one varying slowest); {placeholders} are left to the planner
+    """
+    TOKEN = re.compile(r'@(\w+)')
+    
+    def __init__(self, directory=WORDLISTS_DIR):
+        self.directory = directory
+    
+    def words(self, name: str):
+        with open(os.path.join(self.directory, f"{name}.txt"), encoding='utf-8') as f:
+            for line in f:
+                word = line.strip()
+                if word and not word.startswith('#'):
+                    yield word
+    
+    def directories(self, name: str):
+        """Directory paths from a wordlist, as '' for "/" and '/name' otherwise"""
+        for word in self.words(name):
+            word = word.strip('/')
+            yield f"/{word}" if word else ''
+    
+    def expand(self, name: str):
+        """Every template of name.txt with its @wordlists expanded, in order"""
+        for template in self.words(name):
+            yield from self._expand(template)
+    
+    def _expand(self, template: str):
+        match = self.TOKEN.search(template)
+        if match is None:
+            yield template
+            return
+        for word in self.words(match.group(1)):
+            yield from self._expand(template[:match.start()] + word + template[match.end():])
+
+wordlists = Wordlists()
+
+class PathIndex:
+    """
+    Per-domain record of which candidate templates found files and which
+    missed, persisted as JSON so repeat hosts try what worked first
+    """
+    def __init__(self, path=PATH_INDEX_PATH, max_domains=PATH_INDEX_MAX_DOMAINS):
+        self.path = path
+        self.max_domains = max_domains
+        self._domains = OrderedDict()  # domain -> {template: [successes, failures]}
+        self._save_lock = asyncio.Lock()
+        self._load()
+    
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self._domains.update(json.load(f))
+        except (OSError, ValueError) as e:
+            log.warning("could not load path index", extra={'path': self.path, 'error': str(e)})
+    
+    # Only templates built from the requested path can be learned; the rest
+    # (traversal's fixed index pages, listing entries) name one file for every path
+    PATH_TOKENS = ('{path}', '{base}', '{dir}')
+    
+    @classmethod
+    def learnable(cls, template):
+        return any(token in template for token in cls.PATH_TOKENS)
+    
+    def adjustment(self, domain, template):
+        """
+        Score offset for a template on a domain: templates that found files
+        jump ahead of everything unlearned, repeated misses sink
+        """
+        if not self.learnable(template):
+            return 0
+        stats = self._domains.get(domain, {}).get(template)
+        if not stats:
+            return 0
+        successes, failures = stats
+        if successes:
+            return -10000 * successes / (successes + failures)
+        return 50 * min(failures, 5)
+    
+    def record(self, domain, template, success):
+        templates = self._domains.setdefault(domain, {})
+        self._domains.move_to_end(domain)
+        stats = templates.setdefault(template, [0, 0])
+        stats[0 if success else 1] += 1
+        while len(self._domains) > self.max_domains:
+            self._domains.popitem(last=False)
+    
+    def learn(self, plan, source_url):
+        """Record the winning template and the templates that missed"""
+        winner = plan.by_url.get(source_url)
+        if winner is None or not self.learnable(winner.template):
+            return
+        self.record(plan.domain, winner.template, True)
+        for url in plan.missed:
+            candidate = plan.by_url.get(url)
+            if candidate is not None and candidate.template != winner.template and self.learnable(candidate.template):
+                self.record(plan.domain, candidate.template, False)
+    
+    def templates(self, domain):
+        """Learnable templates recorded for the domain -> [successes, failures]"""
+        return {template: stats for template, stats in self._domains.get(domain, {}).items()
+                if self.learnable(template)}
+    
+    async def save(self):
+        if not self.path:
+            return
+        snapshot = json.dumps(self._domains)
+        async with self._save_lock:
+            await asyncio.to_thread(self._write, snapshot)
+    
+    def _write(self, snapshot):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(snapshot)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning("could not save path index", extra={'path': self.path, 'error': str(e)})
+
+path_index = PathIndex()
+
+class CandidatePlanner:
+    """
+    Builds the RecoveryPlan for a URL: one candidate generator per
+    strategy, with no URL fetched by more than one strategy and templates
+    that worked before on the domain tried first
+    Directory and file names come from the wordlists
+    """
+    DIRECT_LIMIT = 50
+    
+    def __init__(self, path_index=None, wordlists=wordlists):
+        self.path_index = path_index
+        self.wordlists = wordlists
+    
+    def plan(self, url: str):
+        parsed = urlparse(normalize_url(url))
+        plan = RecoveryPlan(url, self.path_index)
+        plan.add('direct', partial(self.direct_candidates, parsed), limit=self.DIRECT_LIMIT)
+        plan.add('download', partial(self.download_candidates, parsed))
+        plan.add('traversal', partial(self.traversal_candidates, parsed))
+        plan.add('brute_force', partial(self.brute_force_candidates, parsed))
+        return plan
+    
+    def direct_candidates(self, parsed):
         domain = parsed.netloc
         path = parsed.path
-        
-        # Extract filename
         filename = os.path.basename(path) if path else 'index.html'
+        candidates = []
         
-        print(f"Domain: {domain}")
-        print(f"Path: {path}")
-        print(f"Filename: {filename}")
-        
-        # Common InfinityFree upload directories
-        common_dirs = [
-            '',  # Root
-            '/public_html',
-            '/htdocs', 
-            '/www',
-            '/files',
-            '/uploads',
-            '/web',
-            '/home',
-        ]
-        
-        # Try different access patterns
-        access_patterns = []
+        def add(url, template, score):
+            candidates.append(Candidate(url, 'direct', template, score))
         
-        # Pattern 1: Direct file access
-        for dir_path in common_dirs:
-            access_patterns.append(f"https://{domain}{dir_path}{path}")
-            access_patterns.append(f"http://{domain}{dir_path}{path}")
+        # Pattern 1: Direct file access (https first, plain http last)
+        for rank, dir_path in enumerate(self.wordlists.directories('directories')):
+            add(f"https://{domain}{dir_path}{path}", f"{dir_path}{{path}}", rank)
+            add(f"http://{domain}{dir_path}{path}", f"http:{dir_path}{{path}}", 300 + rank)
         
-        # Pattern 2: With common extensions
-        for ext in ['.html', '.htm', '.php', '.txt', '.js', '.css']:
-            if not path.endswith(ext):
-                access_patterns.append(f"https://{domain}{path}{ext}")
-        
-        # Pattern 3: Try different filename variations
+        # Pattern 3: Different filename variations
         name_parts = filename.split('.')
         if len(name_parts) > 1:
             base_name = '.'.join(name_parts[:-1])
-            for ext in ['.html', '.htm', '.php']:
-                access_patterns.append(f"https://{domain}{os.path.dirname(path)}/{base_name}{ext}")
+            for rank, ext in enumerate(['.html', '.htm', '.php']):
+                add(f"https://{domain}{os.path.dirname(path)}/{base_name}{ext}", f"{{dir}}/{{base}}{ext}", 100 + rank)
         
-        # Pattern 4: Try user directory patterns (common in InfinityFree)
+        # Pattern 4: User directory patterns (common in InfinityFree)
         username = domain.split('.')[0] if '.' in domain else domain
-        user_dirs = [
-            f"https://{domain}/~{username}{path}",
-            f"https://{domain}/{username}{path}",
-            f"https://{domain}/home/{username}/public_html{path}",
-            f"https://{domain}/home/{username}/htdocs{path}",
+        for rank, template in enumerate(['/~{user}{path}', '/{user}{path}', '/home/{user}/public_html{path}', '/home/{user}/htdocs{path}']):
+            add(f"https://{domain}" + template.format(user=username, path=path), template, 200 + rank)
+        
+        # Pattern 2: Common extensions appended to the full path
+        for rank, ext in enumerate(['.html', '.htm', '.php', '.txt', '.js', '.css']):
+            if not path.endswith(ext):
+                add(f"https://{domain}{path}{ext}", f"{{path}}{ext}", 400 + rank)
+        
+        return candidates
+    
+    def download_candidates(self, parsed):
+        domain = parsed.netloc
+        path = parsed.path
+        queries = ['download', 'download=1', 'force_download', 'raw', 'raw=1', 'source', 'view=source', 'show_source']
+        return [
+            Candidate(f"https://{domain}{path}?{query}", 'download', f"{{path}}?{query}", rank)
+            for rank, query in enumerate(queries)
+        ]
+    
+    def traversal_candidates(self, parsed):
+        domain = parsed.netloc
+        path = parsed.path
+        
+        # Parent directories, nearest first
+        dir_parts = path.split('/')
+        for i in range(1, min(4, len(dir_parts))):
+            parent_path = '/'.join(dir_parts[:-i])
+            if parent_path:
+                yield Candidate(f"https://{domain}{parent_path}/", 'traversal', f"{{parent{i}}}/", i)
+        
+        # Common file locations
+        directories = list(self.wordlists.directories('traversal_dirs'))
+        for rank, file in enumerate(self.wordlists.words('index_files')):
+            for dir_rank, dir_path in enumerate(directories):
+                yield Candidate(f"https://{domain}{dir_path}/{file}", 'traversal', f"{dir_path}/{file}",
+                                10 + rank * len(directories) + dir_rank)
+    
+    @staticmethod
+    def base_name(path: str):
+        """File name of `path` without its extension; 'index' for the root"""
+        if path and path != '/':
+            base_name = os.path.basename(path)
+            if '.' in base_name:
+                return '.'.join(base_name.split('.')[:-1])
+            return base_name
+        return 'index'
+    
+    def brute_force_candidates(self, parsed):
+        domain = parsed.netloc
+        base = self.base_name(parsed.path)
+        
+        # Each name in every directory before moving to the next name
+        directories = list(self.wordlists.directories('brute_force_dirs'))
+        for rank, template in enumerate(self.wordlists.expand('brute_force')):
+            filename = template.replace('{base}', base)
+            for dir_rank, directory in enumerate(directories):
+                yield Candidate(f"https://{domain}{directory}/{filename}", 'brute_force', f"{directory}/{template}",
+                                rank * len(directories) + dir_rank)
+
+    def listing_roots(self, parsed):
+        """Directories whose listings are harvested for a recovery: the file's own, then the common ones"""
+        roots = [f"https://{parsed.netloc}{posixpath.dirname(parsed.path or '/').rstrip('/')}/"]
+        roots += [f"https://{parsed.netloc}{directory}/" for directory in self.wordlists.directories('brute_force_dirs')]
+        return list(dict.fromkeys(roots))
+    
+    def listing_candidates(self, parsed, listings):
+        """
+        Listed files that may be the requested one, most likely first: the
+        same file name, the same base name, then names containing the base
+        """
+        filename = os.path.basename(parsed.path).lower()
+        base = self.base_name(parsed.path).lower()
+        candidates = []
+        for listing in listings:
+            for entry in listing['files']:
+                name = entry['name'].lower()
+                if filename and name == filename:
+                    rank = 0
+                elif name.rsplit('.', 1)[0] == base:
+                    rank = 1
+                elif base and base in name:
+                    rank = 2
+                else:
+                    continue
+                candidates.append(Candidate(entry['url'], 'brute_force', 'listing', rank))
+        return sorted(candidates, key=lambda candidate: candidate.score)
+    
+    def find_files_candidates(self, domain: str):
+        index = itertools.count()
+        for directory in self.wordlists.directories('find_files_dirs'):
+            for filename in self.wordlists.expand('find_files'):
+                yield Candidate(f"https://{domain}{directory}/{filename}", 'find_files', f"{directory}/{filename}", next(index))
+    
+    def find_files_urls(self, domain: str):
+        """Files probed by /api/find-files, directory by directory, generated as they are taken"""
+        plan = RecoveryPlan(domain)
+        plan.add('find_files', partial(self.find_files_candidates, domain))
+        return plan.urls('find_files')
+
+candidate_planner = CandidatePlanner(path_index)
+
+class MemoryCacheBackend:
+    """In-process LRU store, lost on restart"""
+    blocking = False
+    
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def set(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        self._entries.pop(key, None)
+    
+    def clear(self):
+        self._entries.clear()
+
+class SQLiteCacheBackend:
+    """SQLite store so warm entries survive restarts; values are JSON"""
+    blocking = True
+    
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+        self._db.commit()
+    
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return json.loads(row[0])
+    
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, time.time()),
+            )
+            self._db.execute(
+                "DELETE FROM cache WHERE key IN ("
+                "SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+    
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._db.commit()
+    
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM cache")
+            self._db.commit()
+
+class ResultCache:
+    """
+    TTL + LRU cache for recovered files (content and source URL) and for
+    per-candidate misses (404s and trap pages)
+    """
+    def __init__(self, backend, ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+    
+    async def _call(self, method, *args):
+        if self.backend.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+    
+    async def get(self, key):
+        value = await self._call(self.backend.get, key)
+        kind = key.split(':', 1)[0]
+        if value is None:
+            self.misses += 1
+            cache_lookups.inc(kind=kind, result='miss')
+        else:
+            self.hits += 1
+            cache_lookups.inc(kind=kind, result='hit')
+        return value
+    
+    async def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        await self._call(self.backend.set, key, value, expires_at)
+    
+    async def delete(self, key):
+        await self._call(self.backend.delete, key)
+    
+    async def get_recovery(self, url: str):
+        return await self.get(f"recover:{normalize_url(url)}")
+    
+    async def set_recovery(self, url: str, content: str, source_url: str, content_type=None, validators=None):
+        await self.set(f"recover:{normalize_url(url)}", {
+            'content': content,
+            'source_url': source_url,
+            'content_type': content_type,
+            'validators': validators or {},  # Upstream ETag / Last-Modified
+            'checked_at': time.time(),
+        })
+    
+    async def delete_recovery(self, url: str):
+        await self.delete(f"recover:{normalize_url(url)}")
+    
+    @staticmethod
+    def _probe_key(url, headers=None):
+        key = f"probe:{normalize_url(url)}"
+        if headers:
+            key += '|' + json.dumps(headers, sort_keys=True)
+        return key
+    
+    async def get_probe_miss(self, url: str, headers=None):
+        """Cached reason ('missing' / 'trap') a candidate failed, or None"""
+        # A 404 holds for every header set, a trap page only for the one that saw it
+        reason = await self.get(self._probe_key(url))
+        if reason is None and headers:
+            reason = await self.get(self._probe_key(url, headers))
+        trace = current_trace.get()
+        if reason is not None and trace is not None:
+            trace.skipped(url, headers, reason)
+        return reason
+    
+    async def set_probe_miss(self, url: str, reason: str, headers=None):
+        key = self._probe_key(url, headers if reason != 'missing' else None)
+        await self.set(key, reason, ttl=self.negative_ttl)
+
+def create_cache_backend(name=CACHE_BACKEND):
+    if name == 'sqlite':
+        return SQLiteCacheBackend()
+    return MemoryCacheBackend()
+
+result_cache = ResultCache(create_cache_backend())
+
+header_probes_skipped = metrics.counter(
+    'recovery_header_probes_skipped_total', 'Direct-access probes skipped because their header set is redundant on the host'
+)
+
+class HeaderNegotiator:
+    """
+    Learns per host whether the header set changes the response
+    The first candidate URLs on a host are probed with every header set.
+    Header sets that got the same status, verdict, length and content hash
+    on all sampled URLs are equivalent, and afterwards only the first set
+    of each group is sent; on most hosts that is a single set.
+    Pages with markers compare by status and verdict only, since challenge
+    pages differ on every request.
+    """
+    def __init__(self, sample_urls=HEADER_SAMPLE_URLS, ttl=HEADER_NEGOTIATION_TTL,
+                 max_hosts=HEADER_NEGOTIATION_MAX_HOSTS):
+        self.sample_urls = sample_urls
+        self.ttl = ttl
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()  # host -> {'samples': {url: {set key: fingerprint}}, 'keep': set or None}
+    
+    @staticmethod
+    def key(headers):
+        return json.dumps(headers, sort_keys=True)
+    
+    @staticmethod
+    def fingerprint(response):
+        if response.verdict == Verdict.REAL:
+            digest = hashlib.blake2b(response.body, digest_size=8).hexdigest()
+            return (response.status_code, response.verdict.value, len(response.body), digest)
+        return (response.status_code, response.verdict.value)
+    
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None or (state['keep'] is not None and time.time() - state['decided_at'] > self.ttl):
+            state = self._hosts[host] = {'samples': {}, 'keep': None, 'decided_at': None}
+        self._hosts.move_to_end(host)
+        while len(self._hosts) > self.max_hosts:
+            self._hosts.popitem(last=False)
+        return state
+    
+    def header_sets(self, host):
+        """Header set keys still worth sending to the host, or None while sampling"""
+        return self._state(host)['keep']
+    
+    def should_probe(self, url: str, headers):
+        keep = self.header_sets(urlparse(url).netloc)
+        return keep is None or self.key(headers) in keep
+    
+    def record(self, url: str, headers, response, set_keys):
+        """Note one sampled response; `set_keys` lists every header set key in preference order"""
+        host = urlparse(url).netloc
+        state = self._state(host)
+        samples = state['samples']
+        if state['keep'] is not None:
+            return
+        if url not in samples and len(samples) >= self.sample_urls * 3:
+            return  # Enough URLs in the sample already, just waiting for them to complete
+        samples.setdefault(url, {})[self.key(headers)] = self.fingerprint(response)
+        
+        complete = [observed for observed in samples.values() if len(observed) == len(set_keys)]
+        if len(complete) < self.sample_urls:
+            return
+        groups = {}
+        for set_key in set_keys:
+            groups.setdefault(tuple(observed[set_key] for observed in complete), set_key)
+        state['keep'] = set(groups.values())
+        state['decided_at'] = time.time()
+        state['samples'] = {}
+        log.info("header sets negotiated", extra={'host': host, 'kept': len(groups), 'of': len(set_keys)})
+
+header_negotiator = HeaderNegotiator()
+
+class DirectoryListingParser(HTMLParser):
+    """
+    Incremental parser for Apache/nginx/LiteSpeed "Index of" pages and IIS
+    "[To Parent Directory]" pages: feed() it text as it arrives and
+    `entries` fills in with {'url', 'name', 'is_dir', 'size'} for every link
+    to a direct child of `base_url`. Sizes (bytes, None if not given) come
+    from the text after the link, or before it on IIS
+    """
+    SIZE = re.compile(r'^(\d+(?:\.\d+)?)([KMGT]?)$', re.IGNORECASE)
+    UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    ROW_END = {'tr', 'br', 'li', 'p', 'div'}
+    
+    def __init__(self, base_url: str, max_entries=LISTING_MAX_ENTRIES):
+        super().__init__(convert_charrefs=True)
+        base_url = normalize_url(base_url)
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.max_entries = max_entries
+        self.entries = []
+        self.truncated = False  # Stopped at max_entries
+        self.iis = False
+        self._href = None       # Link being read
+        self._link_text = []
+        self._before = []       # Text since the previous link
+        self._after = None      # Text after the last entry's link, until its row ends
+        self._seen = set()
+    
+    @classmethod
+    def parse_size(cls, text: str):
+        tokens = text.split()
+        match = cls.SIZE.match(tokens[-1]) if tokens else None
+        if match is None:
+            return None
+        return int(float(match.group(1)) * cls.UNITS[match.group(2).upper()])
+    
+    def _child(self, href: str):
+        """Absolute URL of `href` if it names a direct child of the listed directory"""
+        if not href or href[0] in '?#' or '?' in href:
+            return None  # Sort links and anchors
+        url = normalize_url(urljoin(self.base_url, href))
+        if not url.startswith(self.base_url) or url == self.base_url:
+            return None  # Parent directory, other sites
+        name = url[len(self.base_url):]
+        if '/' in name.rstrip('/'):
+            return None
+        return url
+    
+    def _close_row(self):
+        if self._after is not None and self.entries and self.entries[-1]['size'] is None:
+            self.entries[-1]['size'] = self.parse_size(''.join(self._after))
+        self._after = None
+    
+    def _boundary(self):
+        # Table cells carry no whitespace of their own: "00:00</td><td>97"
+        self._before.append(' ')
+        if self._after is not None:
+            self._after.append(' ')
+    
+    def handle_starttag(self, tag, attrs):
+        self._boundary()
+        if tag == 'a':
+            self._close_row()
+            self._href = dict(attrs).get('href')
+            self._link_text = []
+        elif tag in self.ROW_END:
+            self._close_row()
+    
+    def handle_startendtag(self, tag, attrs):
+        self._boundary()
+        if tag in self.ROW_END:
+            self._close_row()
+    
+    def handle_endtag(self, tag):
+        self._boundary()
+        if tag == 'a' and self._href is not None:
+            href, self._href = self._href, None
+            before, self._before = ''.join(self._before), []
+            if '[to parent directory]' in ''.join(self._link_text).lower():
+                self.iis = True
+            url = self._child(href)
+            if url is None or url in self._seen:
+                return
+            if len(self.entries) >= self.max_entries:
+                self.truncated = True
+                return
+            self._seen.add(url)
+            is_dir = url.endswith('/') or (self.iis and '<dir>' in before.lower())
+            self.entries.append({
+                'url': url,
+                'name': unquote(url[len(self.base_url):].rstrip('/')),
+                'is_dir': is_dir,
+                'size': self.parse_size(before) if self.iis and not is_dir else None,
+            })
+            self._after = [] if not self.iis else None
+        elif tag in self.ROW_END:
+            self._close_row()
+    
+    def handle_data(self, data):
+        if self._href is not None:
+            self._link_text.append(data)
+            return
+        self._before.append(data)
+        if self._after is not None:
+            line, newline, _ = data.partition('\n')
+            self._after.append(line)
+            if newline:
+                self._close_row()
+    
+    def close(self):
+        super().close()
+        self._close_row()
+    
+    @property
+    def files(self):
+        return [entry for entry in self.entries if not entry['is_dir']]
+    
+    @property
+    def directories(self):
+        return [entry['url'] for entry in self.entries if entry['is_dir']]
+
+class DirectFileAccessor:
+    def __init__(self):
+        self.cache = result_cache
+    
+    async def get_file_content_directly(self, url: str, plan=None):
+        """
+        Try to get file content directly without protection
+        InfinityFree stores files in specific directories
+        """
+        plan = plan or candidate_planner.plan(url)
+        
+        # Try with different headers
+        headers_list = [
+            {'Accept': 'text/plain'},
+            {'Accept': 'text/html'},
+            {'Accept': '*/*'},
+            {'User-Agent': 'curl/7.68.0'},  # Simple curl
+            {'User-Agent': 'Wget/1.20.3'},   # Wget
         ]
-        access_patterns.extend(user_dirs)
         
-        # Remove duplicates
-        access_patterns = list(set(access_patterns))
+        set_keys = [HeaderNegotiator.key(headers) for headers in headers_list]
         
-        print(f"\nTrying {len(access_patterns)} direct access patterns...")
+        candidates = (
+            (pattern_url, headers)
+            for pattern_url in plan.urls('direct')
+            for headers in headers_list
+        )
         
-        for i, pattern_url in enumerate(access_patterns[:50]):  # Limit to 50
-            try:
-                print(f"  [{i+1}] Trying: {pattern_url}")
-                
-                async with httpx.AsyncClient(timeout=15, follow_redirects=True) as client:
-                    # Try with different headers
-                    headers_list = [
-                        {'Accept': 'text/plain'},
-                        {'Accept': 'text/html'},
-                        {'Accept': '*/*'},
-                        {'User-Agent': 'curl/7.68.0'},  # Simple curl
-                        {'User-Agent': 'Wget/1.20.3'},   # Wget
-                    ]
-                    
-                    for headers in headers_list:
-                        try:
-                            response = await client.get(pattern_url, headers=headers)
-                            
-                            if response.status_code == 200:
-                                content = response.text
-                                
-                                # Check if it's actual content (not protection)
-                                if ('aes.js' not in content and 
-                                    'trap for bots' not in content.lower() and
-                                    'content loading' not in content.lower() and
-                                    len(content) > 10):  # Even small files are OK
-                                    
-                                    print(f"  ✓ Found at: {pattern_url}")
-                                    print(f"    Content length: {len(content)}")
-                                    print(f"    Content-Type: {response.headers.get('content-type', 'unknown')}")
-                                    
-                                    return content, pattern_url
-                            
-                            await asyncio.sleep(0.2)
-                        except:
-                            continue
+        log.info("direct access", extra={'url': url})
+        
+        async def probe(candidate):
+            pattern_url, headers = candidate
+            # Once the host is negotiated, redundant header sets are skipped
+            if not header_negotiator.should_probe(pattern_url, headers):
+                header_probes_skipped.inc()
+                return None
+            if await self.cache.get_probe_miss(pattern_url, headers):
+                return None
+            log.debug("probe", extra={'strategy': 'direct', 'url': pattern_url})
+            
+            response = await probe_fetch(pattern_url, headers=headers, timeout=15, follow_redirects=True)
+            header_negotiator.record(pattern_url, headers, response, set_keys)
+            
+            if response.status_code == 404:
+                await self.cache.set_probe_miss(pattern_url, 'missing')
+            elif response.status_code == 200:
+                # Check if it's actual content (not protection)
+                if response.verdict == Verdict.REAL:
+                    content = response.text
+                    log.info("found", extra={
+                        'strategy': 'direct', 'url': pattern_url, 'length': len(content),
+                        'content_type': response.headers.get('content-type', 'unknown'),
+                    })
                     
-            except Exception as e:
-                continue
+                    plan.found[pattern_url] = response
+                    return content, pattern_url
+                
+                await self.cache.set_probe_miss(pattern_url, response.verdict.value, headers)
+            
+            return None
         
-        return None, None
+        return await probe_scheduler.first_success(candidates, plan.tracked(probe)) or (None, None)
     
-    async def try_file_download(self, url: str):
+    async def try_file_download(self, url: str, plan=None):
         """
         Try to trigger file download instead of viewing
         """
-        print(f"\n[Method 2] Trying file download approach...")
-        
-        parsed = urlparse(url)
-        domain = parsed.netloc
-        path = parsed.path
+        log.info("file download", extra={'url': url})
         
-        # Try download parameters
-        download_patterns = [
-            f"https://{domain}{path}?download",
-            f"https://{domain}{path}?download=1",
-            f"https://{domain}{path}?force_download",
-            f"https://{domain}{path}?raw",
-            f"https://{domain}{path}?raw=1",
-            f"https://{domain}{path}?source",
-            f"https://{domain}{path}?view=source",
-            f"https://{domain}{path}?show_source",
-        ]
+        plan = plan or candidate_planner.plan(url)
         
-        for pattern_url in download_patterns:
-            try:
-                print(f"  Trying download: {pattern_url}")
+        async def probe(pattern_url):
+            if await self.cache.get_probe_miss(pattern_url):
+                return None
+            log.debug("probe", extra={'strategy': 'download', 'url': pattern_url})
+            
+            # A download may carry the markers and still be the real file
+            response = await probe_fetch(pattern_url, timeout=15, abort_on_marker=False)
+            
+            if response.status_code == 404:
+                await self.cache.set_probe_miss(pattern_url, 'missing')
+            elif response.status_code == 200:
+                # Check headers for download
+                content_disposition = response.headers.get('content-disposition', '').lower()
+                is_download = 'attachment' in content_disposition or 'download' in content_disposition
                 
-                async with httpx.AsyncClient(timeout=15) as client:
-                    response = await client.get(pattern_url)
-                    
-                    if response.status_code == 200:
-                        content = response.text
-                        
-                        # Check headers for download
-                        content_disposition = response.headers.get('content-disposition', '').lower()
-                        
-                        if ('attachment' in content_disposition or 
-                            'download' in content_disposition or
-                            ('aes.js' not in content and 
-                             'trap for bots' not in content.lower())):
-                            
-                            print(f"  ✓ Download successful: {pattern_url}")
-                            return content, pattern_url
+                if (response.verdict == Verdict.REAL or
+                    (is_download and response.verdict not in (Verdict.TRAP, Verdict.EMPTY))):
                     
-                    await asyncio.sleep(0.5)
-            except:
-                continue
+                    log.info("found", extra={'strategy': 'download', 'url': pattern_url})
+                    plan.found[pattern_url] = response
+                    return response.text, pattern_url
+                
+                await self.cache.set_probe_miss(pattern_url, response.verdict.value)
+            
+            return None
         
-        return None, None
+        return await probe_scheduler.first_success(plan.urls('download'), plan.tracked(probe)) or (None, None)
     
-    async def try_directory_traversal(self, url: str):
+    async def try_directory_traversal(self, url: str, plan=None):
         """
         Try to access files through directory traversal
         """
-        print(f"\n[Method 3] Trying directory traversal...")
-        
-        parsed = urlparse(url)
-        domain = parsed.netloc
-        path = parsed.path
-        
-        # Common directory traversal patterns
-        traversal_patterns = []
-        
-        # Try to go up directories
-        dir_parts = path.split('/')
-        for i in range(1, min(4, len(dir_parts))):
-            parent_path = '/'.join(dir_parts[:-i])
-            if parent_path:
-                traversal_patterns.append(f"https://{domain}{parent_path}/")
-        
-        # Try common file locations
-        common_files = [
-            'index.html', 'index.php', 'index.htm',
-            'default.html', 'default.php',
-            'home.html', 'home.php',
-            'main.html', 'main.php',
-        ]
+        log.info("directory traversal", extra={'url': url})
         
-        for file in common_files:
-            traversal_patterns.append(f"https://{domain}/{file}")
-            traversal_patterns.append(f"https://{domain}/public_html/{file}")
-            traversal_patterns.append(f"https://{domain}/htdocs/{file}")
+        plan = plan or candidate_planner.plan(url)
         
-        for pattern_url in traversal_patterns:
-            try:
-                print(f"  Trying traversal: {pattern_url}")
+        async def probe(pattern_url):
+            if await self.cache.get_probe_miss(pattern_url):
+                return None
+            log.debug("probe", extra={'strategy': 'traversal', 'url': pattern_url})
+            
+            if pattern_url.endswith('/'):
+                response = await plan.directory_page(pattern_url)
+            else:
+                response = await probe_fetch(pattern_url, timeout=10)
+            
+            if response.status_code == 404:
+                await self.cache.set_probe_miss(pattern_url, 'missing')
+            elif response.status_code == 200:
+                if response.verdict == Verdict.REAL:
+                    log.info("found", extra={'strategy': 'traversal', 'url': pattern_url})
+                    plan.found[pattern_url] = response
+                    return response.text, pattern_url
                 
-                async with httpx.AsyncClient(timeout=10) as client:
-                    response = await client.get(pattern_url)
-                    
-                    if response.status_code == 200:
-                        content = response.text
-                        
-                        if ('aes.js' not in content and 
-                            'trap for bots' not in content.lower() and
-                            len(content) > 100):
-                            
-                            print(f"  ✓ Found via traversal: {pattern_url}")
-                            return content, pattern_url
-                    
-                    await asyncio.sleep(0.5)
-            except:
-                continue
+                await self.cache.set_probe_miss(pattern_url, response.verdict.value)
+            
+            return None
         
-        return None, None
+        return await probe_scheduler.first_success(plan.urls('traversal'), plan.tracked(probe)) or (None, None)
     
-    async def extract_uploaded_file(self, url: str):
+    async def extract_uploaded_file(self, url: str, report=None):
         """
         Main method to extract uploaded file
+        All methods race; `report` receives the winner and per-method timings
         """
-        # Method 1: Direct file access
-        print(f"\n[Method 1] Direct file access...")
-        content1, url1 = await self.get_file_content_directly(url)
-        
-        if content1:
-            return content1, url1
-        
-        # Method 2: File download approach
-        print(f"\n[Method 2] File download...")
-        content2, url2 = await self.try_file_download(url)
+        if report is None:
+            report = {}
         
-        if content2:
-            return content2, url2
+        cached = await self.cache.get_recovery(url)
+        if cached:
+            if time.time() - cached.get('checked_at', 0) < CACHE_REVALIDATE_AFTER:
+                log.info("served from cache", extra={'url': url, 'source_url': cached['source_url']})
+                report.update({'winner': 'cache', 'strategies': {}, 'elapsed_ms': 0,
+                               'content_type': cached.get('content_type'),
+                               'validators': cached.get('validators') or {}})
+                return cached['content'], cached['source_url']
+            content = await self.revalidate(url, cached, report)
+            if content is not None:
+                return content, cached['source_url']
         
-        # Method 3: Directory traversal
-        print(f"\n[Method 3] Directory traversal...")
-        content3, url3 = await self.try_directory_traversal(url)
+        plan = candidate_planner.plan(url)
+        report['issued'] = plan.issued
+        content, source_url = None, None
         
-        if content3:
-            return content3, url3
+        # Templates that worked on this domain before get a head start
+        if plan.has_learned():
+            learned_plan = plan.learned()
+            report['learned'] = {}
+            content, source_url = await self._race(url, learned_plan, report['learned'])
+            if content:
+                report.update(winner=report['learned']['winner'], strategies={}, elapsed_ms=report['learned']['elapsed_ms'])
         
-        # Method 4: Try to brute force common files
-        print(f"\n[Method 4] Brute forcing common files...")
-        content4, url4 = await self.brute_force_common_files(url)
+        if not content:
+            content, source_url = await self._race(url, plan, report)
         
-        if content4:
-            return content4, url4
+        if content:
+            log.info("recovered", extra={'url': url, 'winner': report['winner'], 'elapsed_ms': report['elapsed_ms']})
+            found = plan.found.get(source_url)
+            if found is not None:
+                report['content_type'] = found.headers.get('content-type')
+                report['validators'] = found.validators
+                if found.capped:
+                    report['truncated'] = True
+                    log.warning("recovered file cut off at the probe size cap",
+                                extra={'url': url, 'source_url': source_url, 'bytes': len(found.body)})
+            # A streamed recovery only holds the first chunk; it caches once streamed.
+            # Cut-off and oversized files are never cached as the answer
+            streams = current_open_streams.get()
+            if ((streams is None or source_url not in streams) and not report.get('truncated') and
+                    len(content.encode('utf-8', errors='replace')) <= CACHE_MAX_BODY_BYTES):
+                await self.cache.set_recovery(url, content, source_url, report.get('content_type'), report.get('validators'))
+            path_index.learn(plan, source_url)
+            await path_index.save()
+            return content, source_url
         
-        print(f"\n✗ All file access methods failed")
+        log.info("all file access methods failed", extra={'url': url})
         return None, None
     
-    async def brute_force_common_files(self, url: str):
+    async def revalidate(self, url: str, cached, report):
         """
-        Brute force common file names and locations
+        Conditional GET of a cached file's source; a 304 keeps the cached
+        copy, a 200 replaces it. Returns the content, or None when the
+        source is gone and a full recovery is needed
         """
-        parsed = urlparse(url)
-        domain = parsed.netloc
-        path = parsed.path
-        
-        # Extract potential file name
-        if path and path != '/':
-            base_name = os.path.basename(path)
-            if '.' in base_name:
-                name_parts = base_name.split('.')
-                base = '.'.join(name_parts[:-1])
-                ext = name_parts[-1]
-            else:
-                base = base_name
-                ext = ''
-        else:
-            base = 'index'
-            ext = 'html'
+        source_url = cached['source_url']
+        validators = cached.get('validators') or {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        started = time.perf_counter()
+        report.update({'strategies': {}, 'content_type': cached.get('content_type'), 'validators': validators})
+        try:
+            response = await probe_fetch(source_url, headers=headers or None, follow_redirects=True)
+        except Exception as e:
+            # Upstream unreachable: a stale copy beats no copy
+            log.warning("revalidation failed, serving stale copy", extra={'url': url, 'error': str(e)})
+            report.update(winner='cache', revalidated='failed', elapsed_ms=0)
+            return cached['content']
+        report['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
         
-        # Common file variations to try
-        file_variations = []
+        if response.status_code == 304:
+            report.update(winner='cache', revalidated='not_modified')
+            await self.cache.set_recovery(url, cached['content'], source_url, cached.get('content_type'), validators)
+            log.info("revalidated cached copy", extra={'url': url, 'source_url': source_url})
+            return cached['content']
         
-        # Try different extensions
-        for new_ext in ['html', 'htm', 'php', 'txt', 'js', 'css', 'xml', 'json']:
-            file_variations.append(f"{base}.{new_ext}")
+        if response.is_real:
+            content = response.text
+            report.update(winner='revalidate', revalidated='modified',
+                          content_type=response.headers.get('content-type'), validators=response.validators)
+            streams = current_open_streams.get()
+            if streams is None or source_url not in streams:
+                await self.cache.set_recovery(url, content, source_url, report['content_type'], response.validators)
+            log.info("cached copy replaced", extra={'url': url, 'source_url': source_url})
+            return content
         
-        # Try different prefixes/suffixes
-        prefixes = ['', 'main.', 'home.', 'index.', 'default.', 'page.']
-        suffixes = ['', '.old', '.bak', '.backup', '.copy', '.original']
+        await self.cache.delete_recovery(url)
+        for key in ('validators', 'content_type', 'elapsed_ms'):
+            report.pop(key, None)
+        return None
+    
+    async def _race(self, url: str, plan, report):
+        runner = StrategyRunner([
+            ('direct', STRATEGY_WEIGHTS['direct'], partial(self.get_file_content_directly, plan=plan)),          # Method 1
+            ('download', STRATEGY_WEIGHTS['download'], partial(self.try_file_download, plan=plan)),              # Method 2
+            ('traversal', STRATEGY_WEIGHTS['traversal'], partial(self.try_directory_traversal, plan=plan)),      # Method 3
+            ('brute_force', STRATEGY_WEIGHTS['brute_force'], partial(self.brute_force_common_files, plan=plan)), # Method 4
+        ])
+        return await runner.run(url, report)
+    
+    async def brute_force_common_files(self, url: str, plan=None):
+        """
+        Brute force common file names and locations
+        """
+        plan = plan or candidate_planner.plan(url)
         
-        for prefix in prefixes:
-            for suffix in suffixes:
-                for ext in ['html', 'htm', 'php']:
-                    file_variations.append(f"{prefix}{base}{suffix}.{ext}")
+        # A directory listing names the files outright: listed matches go
+        # first, and guesses into a fully listed directory that doesn't list them are dropped
+        # (the head start on learned templates skips the crawl)
+        if not plan.learned_only:
+            parsed = urlparse(normalize_url(url))
+            listings = await self.harvest_listings(candidate_planner.listing_roots(parsed), plan=plan)
+            if listings:
+                complete = {listing['url'] for listing in listings if listing['complete']}
+                listed = candidate_planner.listing_candidates(parsed, listings)
+                plan.seed('brute_force', listed,
+                          drop=lambda candidate_url: candidate_url.rsplit('/', 1)[0] + '/' in complete)
+                log.info("directory listings harvested", extra={
+                    'url': url, 'listings': len(listings), 'listed_candidates': len(listed),
+                })
         
-        # Remove duplicates
-        file_variations = list(set(file_variations))
+        log.info("brute force", extra={'url': url})
+        candidates = plan.urls('brute_force')
         
-        # Common directories
-        directories = ['', '/public_html', '/htdocs', '/www', '/files']
+        async def probe(test_url):
+            if await self.cache.get_probe_miss(test_url):
+                return None
+            log.debug("probe", extra={'strategy': 'brute_force', 'url': test_url})
+            
+            response = await probe_fetch(test_url, timeout=5)
+            
+            if response.status_code == 404:
+                await self.cache.set_probe_miss(test_url, 'missing')
+            elif response.status_code == 200:
+                if response.verdict == Verdict.REAL:
+                    log.info("found", extra={'strategy': 'brute_force', 'url': test_url})
+                    plan.found[test_url] = response
+                    return response.text, test_url
+                
+                await self.cache.set_probe_miss(test_url, response.verdict.value)
+            
+            return None
         
-        print(f"Brute forcing {len(file_variations)} file names in {len(directories)} directories...")
+        return await probe_scheduler.first_success(candidates, plan.tracked(probe)) or (None, None)
+    
+    def structure_endpoints(self, url: str):
+        """Common endpoints checked by analyze_file_structure"""
+        domain = urlparse(url).netloc
+        return [
+            f"https://{domain}/",
+            f"https://{domain}/public_html/",
+            f"https://{domain}/htdocs/",
+            f"https://{domain}/www/",
+            f"https://{domain}/files/",
+            f"https://{domain}/uploads/",
+            f"https://{domain}/.git/",  # Git directory
+            f"https://{domain}/wp-admin/",  # WordPress
+            f"https://{domain}/wp-content/",  # WordPress content
+            f"https://{domain}/admin/",  # Admin panel
+            f"https://{domain}/cgi-bin/",  # CGI directory
+        ]
+    
+    async def probe_structure_endpoint(self, endpoint: str, full=False):
+        """
+        Status, type and size of one endpoint, and whether it is a directory
+        listing; only listings (or everything, with `full`) are read in full
+        """
+        try:
+            if full:
+                response, method = await probe_fetch(endpoint, timeout=10), 'get'
+            else:
+                response, method = await probe_light(endpoint, timeout=10)
+        except (BudgetExhausted, CircuitOpenError):
+            raise
+        except Exception as e:
+            return {
+                'url': endpoint,
+                'error': str(e)
+            }
         
-        for directory in directories:
-            for filename in file_variations[:100]:  # Limit to 100
-                try:
-                    test_url = f"https://{domain}{directory}/{filename}"
-                    
-                    async with httpx.AsyncClient(timeout=5) as client:
-                        response = await client.get(test_url)
-                        
-                        if response.status_code == 200:
-                            content = response.text
-                            
-                            if ('aes.js' not in content and 
-                                'trap for bots' not in content.lower() and
-                                len(content) > 10):
-                                
-                                print(f"  ✓ Found: {test_url}")
-                                return content, test_url
-                        
-                        await asyncio.sleep(0.1)
-                except:
-                    continue
+        if Verdict.DIRECTORY_LISTING in response.markers:
+            # Parsed now so the crawl doesn't fetch it again; a partial read is fetched whole
+            complete = response.status_code == 200 and not response.truncated
+            await self.fetch_listing(endpoint, response if complete else None)
         
-        return None, None
+        return {
+            'url': endpoint,
+            'status': response.status_code,
+            'content_type': response.headers.get('content-type'),
+            'content_length': response.content_length,
+            'verdict': response.verdict.value,
+            'is_listing': Verdict.DIRECTORY_LISTING in response.markers,
+            'probe_method': method,
+        }
     
-    async def analyze_file_structure(self, url: str):
+    async def analyze_file_structure(self, url: str, full=False):
         """
         Analyze the file structure to understand what's uploaded
         """
@@ -359,122 +2913,555 @@ class DirectFileAccessor:
         }
         
         # Test common endpoints
-        test_endpoints = [
-            f"https://{domain}/",
-            f"https://{domain}/public_html/",
-            f"https://{domain}/htdocs/",
-            f"https://{domain}/www/",
-            f"https://{domain}/files/",
-            f"https://{domain}/uploads/",
-            f"https://{domain}/.git/",  # Git directory
-            f"https://{domain}/wp-admin/",  # WordPress
-            f"https://{domain}/wp-content/",  # WordPress content
-            f"https://{domain}/admin/",  # Admin panel
-            f"https://{domain}/cgi-bin/",  # CGI directory
+        test_endpoints = self.structure_endpoints(url)
+        
+        for tested in await probe_scheduler.map(test_endpoints, partial(self.probe_structure_endpoint, full=full)):
+            if tested is None:
+                continue  # Cut short by the call's budget
+            analysis['tested_urls'].append(tested)
+            if tested.get('is_listing'):
+                analysis['directory_listings'].append(tested['url'])
+        
+        # Follow the listings down into their subdirectories
+        listings = await self.harvest_listings(analysis['directory_listings'])
+        analysis['listed_directories'] = [listing['url'] for listing in listings]
+        analysis['listed_files'] = [
+            dict(entry, directory=listing['url'])
+            for listing in listings
+            for entry in listing['files']
         ]
         
-        for endpoint in test_endpoints:
+        return analysis
+    
+    async def fetch_listing(self, directory_url: str, response=None, plan=None):
+        """
+        Files and subdirectories named by a directory listing page, or None
+        if the URL doesn't serve one; cached, and parsed from `response`
+        when the page was fetched already. Within a recovery `plan`, the
+        page is the one its traversal probes share
+        """
+        directory_url = normalize_url(directory_url)
+        key = f"listing:{directory_url}"
+        if response is None:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                return cached or None
             try:
-                async with httpx.AsyncClient(timeout=10) as client:
-                    response = await client.get(endpoint)
-                    
-                    analysis['tested_urls'].append({
-                        'url': endpoint,
-                        'status': response.status_code,
-                        'content_type': response.headers.get('content-type'),
-                        'content_length': len(response.text),
-                    })
-                    
-                    # Check for directory listing
-                    if ('Index of' in response.text or 
-                        '[To Parent Directory]' in response.text or
-                        '<title>Index of' in response.text):
-                        analysis['directory_listings'].append(endpoint)
-                    
-                    await asyncio.sleep(0.5)
+                if plan is not None:
+                    response = await plan.directory_page(directory_url)
+                else:
+                    response = await probe_fetch(directory_url, timeout=10, follow_redirects=True)
+            except (BudgetExhausted, CircuitOpenError):
+                raise
             except Exception as e:
-                analysis['tested_urls'].append({
-                    'url': endpoint,
-                    'error': str(e)
-                })
+                log.debug("listing fetch failed", extra={'url': directory_url, 'error': str(e)})
+                return None
         
-        return analysis
+        if response.status_code != 200 or Verdict.DIRECTORY_LISTING not in response.markers:
+            await self.cache.set(key, {}, ttl=self.cache.negative_ttl)
+            return None
+        
+        parser = DirectoryListingParser(str(response.url))
+        parser.feed(response.text)
+        parser.close()
+        listing = {
+            'url': directory_url,
+            'files': parser.files,
+            'directories': parser.directories,
+            'complete': not (response.truncated or parser.truncated),
+        }
+        await self.cache.set(key, listing)
+        return listing
+    
+    async def harvest_listings(self, roots, max_depth=LISTING_MAX_DEPTH, max_requests=LISTING_MAX_REQUESTS, plan=None):
+        """
+        Breadth-first crawl of the directory listings at `roots`, following
+        subdirectories up to `max_depth` levels down and fetching at most
+        `max_requests` pages; returns the listings found
+        """
+        listings = []
+        seen = set()
+        level = [(normalize_url(root), 0) for root in roots]
+        fetched = 0
+        while level and fetched < max_requests:
+            batch = []
+            for directory_url, depth in level:
+                if directory_url not in seen:
+                    seen.add(directory_url)
+                    batch.append((directory_url, depth))
+            batch = batch[:max_requests - fetched]
+            fetched += len(batch)
+            
+            results = await probe_scheduler.map([directory_url for directory_url, _ in batch],
+                                                partial(self.fetch_listing, plan=plan))
+            level = []
+            for (directory_url, depth), listing in zip(batch, results):
+                if listing is None:
+                    continue
+                listings.append(listing)
+                if depth < max_depth:
+                    level.extend((subdirectory, depth + 1) for subdirectory in listing['directories'])
+        return listings
+    
+    async def probe_find_file(self, test_url: str, full=False):
+        """
+        Result entry for one /api/find-files candidate, from a HEAD or the
+        first PROBE_SNIFF_BYTES; with `full`, confirmed hits are downloaded whole
+        """
+        try:
+            response, method = await probe_light(test_url, timeout=5)
+            if full and response.is_real:
+                try:
+                    response, method = await probe_fetch(test_url, timeout=5), 'get'
+                except BudgetExhausted:
+                    pass  # Report what the light probe already paid for
+            
+            result = {
+                'url': test_url,
+                'status': response.status_code,
+                'content_type': response.headers.get('content-type'),
+                'content_length': response.content_length,
+                'verdict': response.verdict.value,
+                'has_protection': Verdict.PROTECTION in response.markers,
+                'has_trap': Verdict.TRAP in response.markers,
+                'is_accessible': response.is_real,
+                'probe_method': method,
+            }
+            
+            if result['is_accessible'] and response.body:
+                text = response.text
+                result['content_preview'] = text[:200] + "..." if len(text) > 200 else text
+            
+            return result
+            
+        except (BudgetExhausted, CircuitOpenError):
+            raise
+        except Exception as e:
+            return {
+                'url': test_url,
+                'error': str(e)
+            }
 
 file_accessor = DirectFileAccessor()
 
+class RecoveryJob:
+    def __init__(self, url: str, key: str):
+        self.id = base64.urlsafe_b64encode(os.urandom(12)).decode()
+        self.url = url
+        self.key = key
+        self.status = 'queued'  # queued | running | done | failed
+        self.report = {}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.content = None
+        self.source_url = None
+        self.error = None
+    
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+    
+    def to_dict(self, include_content=False):
+        job = {
+            'id': self.id,
+            'url': self.url,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': self.report,
+        }
+        if self.status == 'done':
+            job['result'] = {
+                'found': self.content is not None,
+                'source_url': self.source_url,
+                'content_length': len(self.content) if self.content is not None else 0,
+                'truncated': bool(self.report.get('truncated')),
+            }
+            if include_content:
+                job['result']['content'] = self.content
+        if self.error:
+            job['error'] = self.error
+        return job
+
+class JobManager:
+    """
+    Runs recoveries in the background on an in-process worker pool fed by
+    a bounded queue; a URL already queued or running returns its existing
+    job instead of starting another
+    
+    Jobs live in this process only and are forgotten JOB_TTL seconds after
+    they finish.
+    """
+    def __init__(self, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE, ttl=JOB_TTL):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.jobs = {}
+        self._active = {}  # normalized URL -> queued/running job
+        self._queue = None
+        self._tasks = []
+    
+    def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def close(self):
+        tasks, self._tasks = self._tasks, []
+        self._queue = None
+        self._active.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def submit(self, url: str):
+        """Queue a recovery; returns (job, created). Raises asyncio.QueueFull"""
+        self.start()  # Runtimes without lifespan events start lazily
+        self._expire()
+        key = normalize_url(url)
+        job = self._active.get(key)
+        if job is not None:
+            return job, False
+        
+        job = RecoveryJob(url, key)
+        self._queue.put_nowait(job)
+        self.jobs[job.id] = job
+        self._active[key] = job
+        return job, True
+    
+    def get(self, job_id: str):
+        self._expire()
+        return self.jobs.get(job_id)
+    
+    @property
+    def queued(self):
+        return self._queue.qsize() if self._queue is not None else 0
+    
+    @property
+    def in_flight(self):
+        return len(self._active)
+    
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+    
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = 'running'
+            job.started_at = time.time()
+            try:
+                with call_budget() as budget:
+                    job.content, job.source_url = await file_accessor.extract_uploaded_file(job.url, job.report)
+                job.report['budget'] = budget.to_dict()
+                job.status = 'done'
+            except Exception as e:
+                job.status = 'failed'
+                job.error = str(e)
+            finally:
+                job.finished_at = time.time()
+                self._active.pop(job.key, None)
+                self._queue.task_done()
+
+job_manager = JobManager()
+metrics.gauge('recovery_jobs_in_flight', 'Background recovery jobs queued or running', lambda: job_manager.in_flight)
+
 @app.get("/")
 async def home():
     return templates.TemplateResponse("index.html", {"request": {}})
 
+def content_disposition(source_url: str, content_type: str = None):
+    """
+    Attachment header named after the file the content came from; index.<ext>
+    for a directory, with the extension taken from the content type
+    """
+    name = unquote(posixpath.basename(urlparse(source_url).path))
+    if not name or '.' not in name:
+        media_type = (content_type or 'text/html').split(';')[0].strip().lower()
+        name = f"{name or 'index'}{mimetypes.guess_extension(media_type) or '.html'}"
+    fallback = name.encode('ascii', errors='replace').decode().replace('?', '_').replace('"', '_')
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name)}"
+
+def provenance_comment(url: str, source_url: str, content_type: str):
+    """Header comment naming where the file came from, in the file's own syntax"""
+    note = f"""Recovered from: {url}
+Actual Source URL: {source_url}
+Recovery Time: {datetime.now().isoformat()}
+Tool: InfinityFree Direct File Access v14.0
+Note: This is the actual uploaded file content"""
+    
+    media_type = content_type.split(';')[0].strip().lower()
+    if media_type in ('', 'text/html', 'application/xhtml+xml'):
+        return f"<!DOCTYPE html>\n<!--\n{note}\n-->\n\n"
+    if media_type in ('text/css', 'text/javascript', 'application/javascript', 'application/x-javascript'):
+        return f"/*\n{note}\n*/\n\n"
+    # No comment syntax we can rely on; provenance goes in the headers only
+    return ''
+
+def recovery_etag(source_url: str, validators, content=None):
+    """
+    Weak ETag for a recovered file (the provenance comment differs per
+    response), from the upstream validators or else the content itself
+    """
+    basis = validators.get('etag') or validators.get('last_modified')
+    if basis is None:
+        if content is None:
+            return None
+        basis = hashlib.blake2b(content.encode('utf-8', errors='replace'), digest_size=16).hexdigest()
+    return 'W/"' + hashlib.blake2b(f"{source_url}\n{basis}".encode(), digest_size=12).hexdigest() + '"'
+
+def not_modified(if_none_match, if_modified_since, etag, last_modified):
+    """Whether a client's conditional request can be answered with 304"""
+    if if_none_match:
+        # If-None-Match wins over If-Modified-Since; comparison is weak
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return etag is not None and ('*' in tags or etag.removeprefix('W/') in tags)
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _charset(content_type: str):
+    match = re.search(r'charset=([\w.:-]+)', content_type, re.IGNORECASE)
+    return match.group(1) if match else 'utf-8'
+
+# Identical concurrent /api/recover and /api/find-files calls share one run
+recovery_flights = SingleFlight()
+
+async def locate_recovery(url: str, max_requests=None, deadline_ms=None):
+    """
+    Run a recovery within a call budget and keep the winning upstream
+    response open
+    Returns (content, source_url, report, winner response or None)
+    """
+    report = {}
+    streams = OpenStreams()
+    token = current_open_streams.set(streams)
+    try:
+        with call_budget(max_requests, deadline_ms) as budget:
+            source_code, source_url = await file_accessor.extract_uploaded_file(url, report)
+    finally:
+        current_open_streams.reset(token)
+    report['budget'] = budget.to_dict()
+    winner = streams.take(source_url) if source_code else None
+    await streams.aclose()
+    log.info("strategy report", extra={'url': url, 'report': report})
+    return source_code, source_url, report, winner
+
+async def reopen_source(source_url: str, headers=None):
+    """Fresh streamed response for a source URL found by a shared recovery"""
+    streams = OpenStreams()
+    token = current_open_streams.set(streams)
+    try:
+        await probe_fetch(source_url, headers=headers, follow_redirects=True)
+    finally:
+        current_open_streams.reset(token)
+    winner = streams.take(source_url)
+    await streams.aclose()
+    return winner
+
 @app.get("/api/recover")
-async def recover_source(url: str = Query(..., description="InfinityFree URL to recover source from")):
+async def recover_source(
+    url: str = Query(..., description="InfinityFree URL to recover source from"),
+    trace: bool = Query(False, description="Record the probe timeline; fetch it from /api/traces/{X-Trace-Id}"),
+    if_none_match: str = Header(None),
+    if_modified_since: str = Header(None),
+    max_requests: int = Query(None, ge=1, description="Most upstream requests this call may make"),
+    deadline_ms: int = Query(None, ge=1, description="Stop probing after this many milliseconds"),
+):
     """Recover original uploaded file content"""
     if not url:
         raise HTTPException(status_code=400, detail="URL is required")
     
     try:
-        print(f"\n{'='*60}")
-        print(f"FILE RECOVERY REQUEST: {url}")
-        print(f"Time: {datetime.now().isoformat()}")
-        print(f"{'='*60}")
+        log.info("file recovery request", extra={'url': url})
         
-        # Extract uploaded file
-        source_code, source_url = await file_accessor.extract_uploaded_file(url)
+        if trace:
+            # A traced recovery runs on its own so every probe is in its timeline
+            probe_trace = ProbeTrace(url, 'recover')
+            token = current_trace.set(probe_trace)
+            report = None
+            try:
+                source_code, source_url, report, winner = await locate_recovery(url, max_requests, deadline_ms)
+            finally:
+                current_trace.reset(token)
+                probe_trace.close(report)
+                trace_store.add(probe_trace)
+            trace_headers = {"X-Trace-Id": probe_trace.id}
+        else:
+            # Concurrent requests for the same URL share one recovery
+            source_code, source_url, report, winner = await recovery_flights.do(
+                f"recover:{normalize_url(url)}|{max_requests}|{deadline_ms}",
+                partial(locate_recovery, url, max_requests, deadline_ms),
+            )
+            trace_headers = {}
+        if winner is not None and winner.upstream is not None:
+            if winner.claimed:
+                # Another caller is streaming the shared response; open our own
+                winner = await reopen_source(source_url, winner.request_headers)
+                if winner is None:
+                    raise HTTPException(status_code=503, detail="Recovered file changed while streaming, try again")
+            winner.claimed = True
         
+        budget_header = {"X-Recovery-Budget": json.dumps(report['budget'], separators=(',', ':'))} if 'budget' in report else {}
         if not source_code:
-            raise HTTPException(
-                status_code=404, 
-                detail="Could not access the uploaded file. It might be protected or not directly accessible."
-            )
+            detail = "Could not access the uploaded file. It might be protected or not directly accessible."
+            if report.get('budget', {}).get('exhausted'):
+                detail = f"The {report['budget']['exhausted']} budget ran out before the uploaded file was found."
+            raise HTTPException(status_code=404, detail=detail, headers={**trace_headers, **budget_header} or None)
         
-        # Check if it's trap content
-        if ('trap for bots' in source_code.lower() or 
-            'content loading' in source_code.lower()):
-            
-            raise HTTPException(
-                status_code=404,
-                detail="Found bot trap content. The actual file might be in a different location or protected."
+        headers = {
+            "Content-Disposition": content_disposition(
+                source_url, winner.headers.get('content-type') if winner is not None else report.get('content_type')
+            ),
+            # Header values are Latin-1; percent-encode anything else in the URL
+            "X-Recovery-Source": quote(source_url, safe=":/?#[]@!$&'()*+,;=%"),
+            "X-Recovery-Strategy": report['winner'],
+            "X-Recovery-Timings": json.dumps(report['strategies'], separators=(',', ':')),
+            **({"X-Recovery-Truncated": "1"} if report.get('truncated') else {}),
+            **budget_header,
+            **trace_headers,
+        }
+        
+        validators = winner.validators if winner is not None else report.get('validators') or {}
+        # Without upstream validators the tag hashes the content, which is only
+        # known up front when the body was read in full; a still-streaming
+        # body from a host that sends no validators goes out untagged
+        fully_read = winner is None or winner.upstream is None
+        etag = recovery_etag(source_url, validators, source_code if fully_read else None)
+        if etag:
+            headers["ETag"] = etag
+        if validators.get('last_modified'):
+            headers["Last-Modified"] = validators['last_modified']
+        if not_modified(if_none_match, if_modified_since, etag, validators.get('last_modified')):
+            if winner is not None:
+                await winner.aclose()
+            return Response(status_code=304, headers=headers)
+        
+        if winner is None:
+            # Served from cache, or accepted without a registered response
+            content_type = report.get('content_type') or "text/html; charset=utf-8"
+            prefix = provenance_comment(url, source_url, content_type)
+            return Response(
+                content=(prefix + source_code).encode(_charset(content_type), errors='replace'),
+                media_type=content_type,
+                headers=headers,
             )
         
-        # Create recovered file
-        clean_html = f"""<!DOCTYPE html>
-<!--
-Recovered from: {url}
-Actual Source URL: {source_url}
-Recovery Time: {datetime.now().isoformat()}
-Tool: InfinityFree Direct File Access v14.0
-Note: This is the actual uploaded file content
--->
-
-{source_code}
-"""
-        
-        # Return as downloadable file
-        return Response(
-            content=clean_html,
-            media_type="text/html",
-            headers={
-                "Content-Disposition": "attachment; filename=recovered-original-file.html",
-                "Content-Type": "text/html; charset=utf-8",
-            }
-        )
+        # Stream the upstream body with the provenance comment as first chunk
+        content_type = winner.headers.get('content-type') or "text/html; charset=utf-8"
+        prefix = provenance_comment(url, source_url, content_type).encode(winner.encoding, errors='replace')
+        if winner.upstream is None:
+            headers["Content-Length"] = str(len(prefix) + len(winner.body))
+        elif (winner.headers.get('content-length', '').isdigit() and
+              winner.headers.get('content-encoding', 'identity') == 'identity'):
+            headers["Content-Length"] = str(len(prefix) + int(winner.headers['content-length']))
+        
+        async def body():
+            cached = bytearray()
+            complete = False
+            try:
+                yield prefix
+                async for chunk in winner.aiter_body():
+                    if cached is not None:
+                        if len(cached) + len(chunk) <= CACHE_MAX_BODY_BYTES:
+                            cached += chunk
+                        else:
+                            cached = None  # Too large to cache
+                    yield chunk
+                complete = True
+            finally:
+                await winner.aclose()
+            if complete and cached is not None and not winner.capped:
+                await result_cache.set_recovery(
+                    url, cached.decode(winner.encoding, errors='replace'), source_url, content_type, winner.validators
+                )
+        
+        return StreamingResponse(body(), media_type=content_type, headers=headers)
         
     except HTTPException:
         raise
+    except CircuitOpenError as e:
+        raise host_unavailable(e)
     except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("file recovery failed", extra={'url': url})
         raise HTTPException(status_code=500, detail=f"File recovery failed: {str(e)}")
 
+STREAM_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+def stream_events(events, mode: str):
+    """
+    StreamingResponse writing each (event, payload) pair as soon as it is
+    produced, as NDJSON lines or Server-Sent Events
+    """
+    if mode not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"stream must be one of: {', '.join(STREAM_MEDIA_TYPES)}")
+    
+    def encode(event, payload):
+        if mode == 'sse':
+            return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        return json.dumps({'event': event, **payload}) + "\n"
+    
+    async def body():
+        try:
+            async for event, payload in events:
+                yield encode(event, payload)
+        except CircuitOpenError as e:
+            # Too late for a 503: the stream ends with the reason instead
+            yield encode('error', {'status': 503, 'error': f"Upstream host unavailable: {e}",
+                                   'retry_after': host_unavailable(e).headers['Retry-After']})
+    
+    return StreamingResponse(body(), media_type=STREAM_MEDIA_TYPES[mode],
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.get("/api/analyze-structure")
-async def analyze_structure(url: str = Query(..., description="URL to analyze file structure")):
+async def analyze_structure(
+    url: str = Query(..., description="URL to analyze file structure"),
+    stream: str = Query(None, description="Stream each endpoint as it is probed: ndjson or sse"),
+    full: bool = Query(False, description="GET every endpoint in full instead of HEAD / a ranged read"),
+    max_requests: int = Query(None, ge=1, description="Most upstream requests this call may make"),
+    deadline_ms: int = Query(None, ge=1, description="Stop probing after this many milliseconds"),
+):
     """Analyze the file structure of an InfinityFree site"""
     if not url:
         raise HTTPException(status_code=400, detail="URL is required")
     
+    if stream:
+        async def events():
+            endpoints = file_accessor.structure_endpoints(url)
+            listing_urls = []
+            listed_files = 0
+            probe = partial(file_accessor.probe_structure_endpoint, full=full)
+            # Set inside the generator so the budget lives in the streaming task's context
+            with call_budget(max_requests, deadline_ms) as budget:
+                async for tested in probe_scheduler.as_completed(endpoints, probe):
+                    if tested.get('is_listing'):
+                        listing_urls.append(tested['url'])
+                    yield 'result', tested
+                for listing in await file_accessor.harvest_listings(listing_urls):
+                    listed_files += len(listing['files'])
+                    yield 'listing', listing
+            yield 'summary', {
+                'domain': urlparse(url).netloc, 'tested_urls': len(endpoints),
+                'directory_listings': len(listing_urls), 'listed_files': listed_files,
+                'budget': budget.to_dict(),
+            }
+        
+        return stream_events(events(), stream)
+    
     try:
-        analysis = await file_accessor.analyze_file_structure(url)
+        with call_budget(max_requests, deadline_ms) as budget:
+            analysis = await file_accessor.analyze_file_structure(url, full=full)
+        analysis['budget'] = budget.to_dict()
         
         return JSONResponse({
             'analysis': analysis,
@@ -485,80 +3472,92 @@ async def analyze_structure(url: str = Query(..., description="URL to analyze fi
             ]
         })
         
+    except CircuitOpenError as e:
+        raise host_unavailable(e)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @app.get("/api/find-files")
-async def find_files(url: str = Query(..., description="Base URL to find files")):
+async def find_files(
+    url: str = Query(..., description="Base URL to find files"),
+    stream: str = Query(None, description="Stream each result as it completes: ndjson or sse"),
+    trace: bool = Query(False, description="Include the probe timeline under 'trace'"),
+    full: bool = Query(False, description="Download accessible files in full (sizes and verdicts from the whole body)"),
+    max_requests: int = Query(None, ge=1, description="Most upstream requests this call may make"),
+    deadline_ms: int = Query(None, ge=1, description="Stop probing after this many milliseconds"),
+):
     """Find accessible files on an InfinityFree site"""
     if not url:
         raise HTTPException(status_code=400, detail="URL is required")
     
-    try:
-        parsed = urlparse(url)
-        domain = parsed.netloc
+    domain = urlparse(url).netloc
+    probe_trace = ProbeTrace(url, 'find_files') if trace else None
+    probe = partial(file_accessor.probe_find_file, full=full)
+    
+    if stream:
+        async def events():
+            tested = accessible = 0
+            test_urls = candidate_planner.find_files_urls(domain)
+            token = current_trace.set(probe_trace)
+            try:
+                with call_budget(max_requests, deadline_ms) as budget:
+                    async for result in probe_scheduler.as_completed(test_urls, probe):
+                        tested += 1
+                        accessible += bool(result.get('is_accessible'))
+                        yield 'result', result
+            finally:
+                current_trace.reset(token)
+            summary = {'domain': domain, 'tested_files': tested, 'accessible_files': accessible,
+                       'budget': budget.to_dict()}
+            if probe_trace is not None:
+                probe_trace.close()
+                trace_store.add(probe_trace)
+                summary['trace'] = probe_trace.to_dict()
+            yield 'summary', summary
         
+        return stream_events(events(), stream)
+    
+    try:
         # Common files to check
-        common_files = [
-            'index.html', 'index.php', 'index.htm',
-            'default.html', 'default.php',
-            'home.html', 'home.php',
-            'main.html', 'main.php',
-            'style.css', 'styles.css',
-            'script.js', 'main.js',
-            'config.php', 'settings.php',
-            'robots.txt', 'sitemap.xml',
-            '.htaccess', 'web.config',
-        ]
+        test_urls = candidate_planner.find_files_urls(domain)
         
-        # Directories to check
-        directories = ['', '/public_html', '/htdocs', '/www', '/files', '/uploads']
+        async def probe_all():
+            with call_budget(max_requests, deadline_ms) as budget:
+                results = await probe_scheduler.map(test_urls, probe)
+            # Probes the budget cut short come back as None
+            return [r for r in results if r is not None], budget.to_dict()
         
-        results = []
-        
-        for directory in directories:
-            for filename in common_files:
-                test_url = f"https://{domain}{directory}/{filename}"
-                
-                try:
-                    async with httpx.AsyncClient(timeout=5) as client:
-                        response = await client.get(test_url)
-                        
-                        result = {
-                            'url': test_url,
-                            'status': response.status_code,
-                            'content_type': response.headers.get('content-type'),
-                            'content_length': len(response.text),
-                            'has_protection': 'aes.js' in response.text,
-                            'has_trap': 'trap for bots' in response.text.lower(),
-                            'is_accessible': (response.status_code == 200 and 
-                                            'aes.js' not in response.text and
-                                            'trap for bots' not in response.text.lower())
-                        }
-                        
-                        if result['is_accessible']:
-                            result['content_preview'] = response.text[:200] + "..." if len(response.text) > 200 else response.text
-                        
-                        results.append(result)
-                        
-                        await asyncio.sleep(0.1)
-                        
-                except Exception as e:
-                    results.append({
-                        'url': test_url,
-                        'error': str(e)
-                    })
+        if probe_trace is not None:
+            # Traced runs don't share results, so the timeline is their own
+            token = current_trace.set(probe_trace)
+            try:
+                results, budget = await probe_all()
+            finally:
+                current_trace.reset(token)
+                probe_trace.close()
+                trace_store.add(probe_trace)
+        else:
+            results, budget = await recovery_flights.do(
+                f"find-files:{domain.lower()}:{'full' if full else 'light'}:{max_requests}:{deadline_ms}",
+                probe_all,
+            )
         
         # Filter accessible files
         accessible_files = [r for r in results if r.get('is_accessible')]
         
-        return JSONResponse({
+        response = {
             'domain': domain,
             'tested_files': len(results),
             'accessible_files': accessible_files,
-            'all_results': results
-        })
+            'all_results': results,
+            'budget': budget,
+        }
+        if probe_trace is not None:
+            response['trace'] = probe_trace.to_dict()
+        return JSONResponse(response)
         
+    except CircuitOpenError as e:
+        raise host_unavailable(e)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
@@ -566,39 +3565,263 @@ async def find_files(url: str = Query(..., description="Base URL to find files")
 async def debug_file(url: str = Query(..., description="File URL to debug")):
     """Debug file access"""
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.get(url, follow_redirects=True)
-            
-            parsed = urlparse(url)
-            filename = os.path.basename(parsed.path) if parsed.path else 'unknown'
-            
-            debug_info = {
-                "requested_url": url,
-                "final_url": str(response.url),
-                "filename": filename,
-                "status_code": response.status_code,
-                "content_length": len(response.text),
-                "content_type": response.headers.get('content-type'),
-                "headers": dict(response.headers),
-                "has_aes_protection": 'aes.js' in response.text,
-                "has_trap_content": 'trap for bots' in response.text.lower() or 'content loading' in response.text.lower(),
-                "content_preview": response.text[:1000] + "..." if len(response.text) > 1000 else response.text,
-                "recommendations": [
-                    "Try accessing file through /public_html/ or /htdocs/ directory",
-                    "Try adding ?download or ?raw parameter",
-                    "Check if file exists with different extension (.html, .php, .htm)"
-                ]
-            }
-            
-            return JSONResponse(debug_info)
-            
+        response = await probe_fetch(url, follow_redirects=True, timeout=30, abort_on_marker=False)
+        
+        parsed = urlparse(url)
+        filename = os.path.basename(parsed.path) if parsed.path else 'unknown'
+        
+        debug_info = {
+            "requested_url": url,
+            "final_url": str(response.url),
+            "filename": filename,
+            "status_code": response.status_code,
+            "content_length": response.content_length,
+            "content_type": response.headers.get('content-type'),
+            "headers": dict(response.headers),
+            "verdict": response.verdict.value,
+            "has_aes_protection": Verdict.PROTECTION in response.markers,
+            "has_trap_content": Verdict.TRAP in response.markers,
+            "content_preview": response.text[:1000] + "..." if len(response.text) > 1000 else response.text,
+            "recommendations": [
+                "Try accessing file through /public_html/ or /htdocs/ directory",
+                "Try adding ?download or ?raw parameter",
+                "Check if file exists with different extension (.html, .php, .htm)"
+            ]
+        }
+        
+        return JSONResponse(debug_info)
+        
+    except CircuitOpenError as e:
+        raise host_unavailable(e)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
+@app.post("/api/jobs", status_code=202)
+async def create_job(url: str = Query(..., description="InfinityFree URL to recover in the background")):
+    """Start a background recovery and return its job id right away"""
+    if not url:
+        raise HTTPException(status_code=400, detail="URL is required")
+    
+    try:
+        job, created = job_manager.submit(url)
+    except asyncio.QueueFull:
+        raise HTTPException(
+            status_code=503,
+            detail="Recovery queue is full, try again shortly",
+            headers={"Retry-After": "5"},
+        )
+    
+    return JSONResponse(
+        {**job.to_dict(), 'coalesced': not created},
+        status_code=202,
+        headers={"Location": f"/api/jobs/{job.id}"},
+    )
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, include_content: bool = Query(True, description="Include the recovered file in the result")):
+    """Status, progress and (once done) result of a background recovery"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return JSONResponse(job.to_dict(include_content))
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-Sent Events feed of a background recovery's progress"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    
+    async def events():
+        last = None
+        while not job.finished:
+            snapshot = job.to_dict()
+            encoded = json.dumps(snapshot, sort_keys=True)
+            if encoded != last:
+                last = encoded
+                yield 'progress', snapshot
+            await asyncio.sleep(JOB_PROGRESS_INTERVAL)
+        yield 'done', job.to_dict()
+    
+    return stream_events(events(), 'sse')
+
+class BatchRecoveryRequest(BaseModel):
+    urls: list[str]
+    format: str = 'ndjson'  # ndjson | sse | zip
+    concurrency: int = BATCH_CONCURRENCY
+
+async def recover_batch(urls, concurrency=BATCH_CONCURRENCY):
+    """
+    Recover many URLs, yielding (url, requested, content, source_url, report)
+    as each finishes, where `requested` lists the caller's spellings of the
+    normalized url. URLs are grouped by host and each host's first URL runs
+    alone, so the rest start with its learned layout and negotiated header
+    sets; the connection pool is shared throughout
+    """
+    requested = OrderedDict()  # normalized url -> the URLs as the caller wrote them
+    for url in urls:
+        requested.setdefault(normalize_url(url), []).append(url)
+    by_host = OrderedDict()
+    for url in requested:
+        by_host.setdefault(urlparse(url).netloc, []).append(url)
+    
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    
+    async def recover(url, pilot_done=None):
+        if pilot_done is not None:
+            await pilot_done.wait()
+        report = {}
+        async with semaphore:
+            try:
+                with call_budget() as budget:
+                    content, source_url = await file_accessor.extract_uploaded_file(url, report)
+                report['budget'] = budget.to_dict()
+            except Exception as e:
+                content, source_url = None, None
+                report['error'] = str(e)
+        return url, requested[url], content, source_url, report
+    
+    async def pilot(url, done):
+        try:
+            return await recover(url)
+        finally:
+            done.set()
+    
+    tasks = []
+    for host_urls in by_host.values():
+        done = asyncio.Event()
+        tasks.append(asyncio.create_task(pilot(host_urls[0], done)))
+        tasks.extend(asyncio.create_task(recover(url, done)) for url in host_urls[1:])
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def batch_result(url, requested, content, source_url, report, include_content=True):
+    result = {
+        'url': url,
+        'requested': requested,
+        'found': bool(content),
+        'source_url': source_url,
+        'strategy': report.get('winner'),
+        'elapsed_ms': report.get('elapsed_ms'),
+    }
+    if report.get('error'):
+        result['error'] = report['error']
+    if content:
+        result['content_type'] = report.get('content_type')
+        result['truncated'] = bool(report.get('truncated'))
+        if include_content:
+            result['content'] = content
+    return result
+
+def zip_member_name(url: str):
+    """Archive path for a recovered URL: host/path, index.html for directories"""
+    parsed = urlparse(url)
+    path = parsed.path.lstrip('/')
+    if not path or path.endswith('/'):
+        path += 'index.html'
+    return f"{parsed.netloc}/{path}"
+
+class _ZipChunks:
+    """Write-only file object that collects what zipfile writes, for streaming"""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def seekable(self):
+        return False
+    
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+@app.post("/api/recover/batch")
+async def recover_batch_endpoint(batch: BatchRecoveryRequest):
+    """
+    Recover many files in one request, streamed as NDJSON/SSE results or
+    as a zip of the recovered files with a manifest.json
+    """
+    if not batch.urls:
+        raise HTTPException(status_code=400, detail="urls must not be empty")
+    if len(batch.urls) > BATCH_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_URLS} URLs per batch")
+    if batch.format not in ('zip', *STREAM_MEDIA_TYPES):
+        raise HTTPException(status_code=400, detail=f"format must be one of: zip, {', '.join(STREAM_MEDIA_TYPES)}")
+    concurrency = min(max(1, batch.concurrency), BATCH_CONCURRENCY)
+    
+    if batch.format != 'zip':
+        async def events():
+            started = time.perf_counter()
+            recovered = failed = 0
+            async for url, requested, content, source_url, report in recover_batch(batch.urls, concurrency):
+                recovered += bool(content)
+                failed += not content
+                yield 'result', batch_result(url, requested, content, source_url, report)
+            # requested == deduplicated + recovered + failed
+            yield 'summary', {
+                'requested': len(batch.urls),
+                'deduplicated': len(batch.urls) - recovered - failed,
+                'recovered': recovered,
+                'failed': failed,
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+            }
+        
+        return stream_events(events(), batch.format)
+    
+    async def archive():
+        out = _ZipChunks()
+        manifest = []
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+            async for url, requested, content, source_url, report in recover_batch(batch.urls, concurrency):
+                result = batch_result(url, requested, content, source_url, report, include_content=False)
+                if content:
+                    result['file'] = zip_member_name(url)
+                    encoding = _charset(report.get('content_type') or '')
+                    zf.writestr(result['file'], content.encode(encoding, errors='replace'))
+                manifest.append(result)
+                yield out.take()
+            zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+        yield out.take()
+    
+    return StreamingResponse(
+        archive(),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=recovered-files.zip"},
+    )
+
+@app.get("/api/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Probe timeline of a recent ?trace=1 request"""
+    probe_trace = trace_store.get(trace_id)
+    if probe_trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found or expired")
+    return JSONResponse(probe_trace.to_dict())
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Counters and histograms in the Prometheus text format"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/api/protected")
 async def extract_protected_content(url: str = Query(..., description="Protected URL to extract from")):
     """Legacy endpoint - redirects to recover"""
-    return await recover_source(url)
+    return await recover_source(url, trace=False, if_none_match=None, if_modified_since=None,
+                                max_requests=None, deadline_ms=None)
 
 if __name__ == "__main__":
     import uvicorn
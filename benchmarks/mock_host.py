@@ -0,0 +1,197 @@
+"""
+Offline stand-in for an InfinityFree account, served through httpx.MockTransport
+
+    /<anything>            aes.js protection page (what browsers get on InfinityFree)
+    /htdocs/<file>         the uploaded files
+    /htdocs/, /htdocs/<dir>/  Apache-style directory listings of the uploads
+    any ?query             bot-trap page
+    /files/...             slow responses
+    /uploads/...           requests that time out
+    everything else        404 page
+
+HEAD requests get the headers only. Uploaded files (static, unlike the
+pages) honour "Range: bytes=a-b" with a 206.
+
+Hosts other than `domain` behave the same but have nothing uploaded; hosts
+in `soft_404_hosts` answer 200 with a landing page (echoing the path)
+instead of the 404 page and the protection page.
+"""
+import asyncio
+import re
+import time
+
+import httpx
+
+PROTECTION_PAGE = b"""<html><body>
+<script type="text/javascript" src="/aes.js"></script>
+<script>function toNumbers(d){var e=[];d.replace(/(..)/g,function(d){e.push(parseInt(d,16))});return e}
+var a=toNumbers("f655ba9d09a112d4968c63579db590b4"),b=toNumbers("98344c2eee86c3994890592585b49f80");
+document.cookie="__test="+toHex(slowAES.decrypt(c,2,a,b))+"; expires=Thu, 31-Dec-37 23:55:55 GMT; path=/";
+location.href="?i=1";</script>
+<noscript>This site requires Javascript to work, please enable Javascript in your browser or use a browser with Javascript support</noscript>
+</body></html>"""
+
+TRAP_PAGE = b"""<html><head><title>Please wait</title></head><body>
+<p>Content loading...</p><a href="/trap-for-bots/" style="display:none">trap for bots</a>
+</body></html>"""
+
+SOFT_404_PAGE = """<!DOCTYPE html><html><head><title>Site not found</title></head><body>
+<h1>Nothing here yet</h1><p>We could not find {path} on this site. It may have moved,
+or the owner has not uploaded it yet.</p><p>Generated at {time}.</p></body></html>"""
+
+NOT_FOUND_PAGE = b"""<html><head><title>404 Not Found</title></head>
+<body><h1>Not Found</h1><p>The requested URL was not found on this server.</p></body></html>"""
+
+# Uploaded files: path under /htdocs -> body
+DEFAULT_FILES = {
+    '/index.html': b"<!DOCTYPE html><html><head><title>My site</title></head><body><h1>Welcome</h1></body></html>",
+    '/about.html': b"<!DOCTYPE html><html><head><title>About</title></head><body><p>About this site.</p></body></html>",
+    '/contact.php': b"<?php $to = 'admin@example.com'; if ($_POST) { mail($to, 'Contact', $_POST['msg']); } ?>",
+    '/style.css': b"body { font-family: sans-serif; margin: 0 auto; max-width: 60em; }",
+    '/robots.txt': b"User-agent: *\nDisallow: /private/\n",
+    '/assets/app.js': b"document.addEventListener('DOMContentLoaded', function () { console.log('ready'); });",
+}
+
+LARGE_FILE = '/large.html'
+
+
+class MockInfinityFreeHost:
+    """
+    Request handler for httpx.MockTransport imitating one InfinityFree site
+    Counts every request it answers, per kind of answer
+    """
+    def __init__(self, domain='bench.example.com', files=None, slow_delay=0.2, timeout_delay=0.05,
+                 large_size=5 * 1024 * 1024, chunk_size=64 * 1024, soft_404_hosts=()):
+        self.domain = domain
+        self.soft_404_hosts = set(soft_404_hosts)
+        self.files = dict(DEFAULT_FILES if files is None else files)
+        self.slow_delay = slow_delay
+        self.timeout_delay = timeout_delay  # How long a "timed out" request takes to fail
+        self.large_size = large_size
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.bytes_sent = 0
+        self.by_kind = {}
+
+    def transport(self):
+        return httpx.MockTransport(self)
+
+    def reset(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.by_kind = {}
+
+    def _count(self, kind, size=0):
+        self.requests += 1
+        self.bytes_sent += size
+        self.by_kind[kind] = self.by_kind.get(kind, 0) + 1
+
+    def _html(self, request, kind, body, status_code=200):
+        headers = {'content-type': 'text/html; charset=UTF-8'}
+        if request.method == 'HEAD':
+            self._count(kind)
+            return httpx.Response(status_code, headers={**headers, 'content-length': str(len(body))})
+        self._count(kind, len(body))
+        return httpx.Response(status_code, content=body, headers=headers)
+
+    @staticmethod
+    def _range(request, size):
+        """(start, end) of a satisfiable "bytes=a-b" Range header, else None"""
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers.get('range', ''))
+        if match is None or int(match.group(1)) >= size:
+            return None
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        return start, end
+
+    def _static(self, request, kind, content_type, size, body=None):
+        """A static file of `size` bytes: `body`, or the generated large file when None"""
+        headers = {'content-type': content_type, 'accept-ranges': 'bytes'}
+        if request.method == 'HEAD':
+            self._count(kind)
+            return httpx.Response(200, headers={**headers, 'content-length': str(size)})
+        byte_range = self._range(request, size)
+        if byte_range is not None:
+            start, end = byte_range
+            piece = body[start:end + 1] if body is not None else self._large_bytes(start, end + 1)
+            self._count(kind, len(piece))
+            return httpx.Response(206, content=piece, headers={
+                **headers, 'content-range': f'bytes {start}-{end}/{size}',
+            })
+        self._count(kind, size)
+        if body is not None:
+            return httpx.Response(200, content=body, headers=headers)
+        return httpx.Response(200, content=self._large_body(), headers={**headers, 'content-length': str(size)})
+
+    def _large_chunk(self):
+        return b"<p>" + b"x" * (self.chunk_size - 8) + b"</p>\n"
+
+    def _large_bytes(self, start, end):
+        chunk = self._large_chunk()
+        return b''.join(chunk[max(start - offset, 0):end - offset]
+                        for offset in range(start - start % len(chunk), end, len(chunk)))
+
+    async def _large_body(self):
+        chunk = self._large_chunk()
+        sent = 0
+        while sent < self.large_size:
+            piece = chunk[:self.large_size - sent]
+            sent += len(piece)
+            yield piece
+            await asyncio.sleep(0)
+
+    async def __call__(self, request: httpx.Request):
+        path = request.url.path
+
+        if request.url.query:
+            return self._html(request, 'trap', TRAP_PAGE)
+
+        if path.startswith('/uploads/'):
+            self._count('timeout')
+            await asyncio.sleep(self.timeout_delay)
+            raise httpx.ReadTimeout("Mock host timed out", request=request)
+
+        if path.startswith('/files/'):
+            await asyncio.sleep(self.slow_delay)
+            return self._html(request, 'slow', NOT_FOUND_PAGE, 404)
+
+        if path.startswith('/htdocs/') and request.url.host == self.domain:
+            name = path[len('/htdocs'):]
+            if name.endswith('/') and any(file.startswith(name) for file in self.files):
+                return self._html(request, 'listing', self.listing(name))
+            if name == LARGE_FILE:
+                return self._static(request, 'large', 'text/html; charset=UTF-8', self.large_size)
+            body = self.files.get(name)
+            if body is not None:
+                content_type = {'css': 'text/css', 'txt': 'text/plain', 'js': 'application/javascript'}.get(
+                    name.rsplit('.', 1)[-1], 'text/html')
+                return self._static(request, 'file', content_type, len(body), body)
+            return self._html(request, 'missing', NOT_FOUND_PAGE, 404)
+
+        if request.url.host in self.soft_404_hosts:
+            return self._html(request, 'soft_404', SOFT_404_PAGE.format(path=path, time=time.time_ns()).encode())
+
+        if path == '/' or '.' in path.rsplit('/', 1)[-1]:
+            return self._html(request, 'protection', PROTECTION_PAGE)
+
+        return self._html(request, 'missing', NOT_FOUND_PAGE, 404)
+
+    def listing(self, directory='/'):
+        modified = time.strftime('%Y-%m-%d %H:%M', time.gmtime(0))
+        entries = {}  # name -> size, or '-' for subdirectories
+        for name, body in self.files.items():
+            if name.startswith(directory):
+                child, slash, _ = name[len(directory):].partition('/')
+                entries[child + slash] = '-' if slash else len(body)
+        if directory == '/':
+            entries[LARGE_FILE.lstrip('/')] = self.large_size
+        rows = ''.join(
+            f'<tr><td><a href="{name}">{name}</a></td><td>{modified}</td><td>{size}</td></tr>\n'
+            for name, size in sorted(entries.items())
+        )
+        return (
+            f'<html><head><title>Index of /htdocs{directory}</title></head><body><h1>Index of /htdocs{directory}</h1>\n'
+            '<table><tr><th>Name</th><th>Last modified</th><th>Size</th></tr>\n'
+            '<tr><td><a href="../">Parent Directory</a></td><td></td><td>-</td></tr>\n'
+            f'{rows}</table></body></html>'
+        ).encode()
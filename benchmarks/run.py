@@ -0,0 +1,194 @@
+"""
+Offline benchmarks: recoveries, /api/find-files and /api/analyze-structure
+against the mock InfinityFree host, with no network access
+
+    python -m benchmarks.run
+    python -m benchmarks.run --concurrency 32 --per-host 8 --host-rate 200
+    python -m benchmarks.run --scenarios recover-htdocs,find-files --iterations 20
+    python -m benchmarks.run --json > bench_output.txt
+
+Each scenario reports upstream requests made, bytes the host sent, wall
+time, p50/p99 latency and peak traced memory. Caches, the learned path index, header
+negotiation, soft-404 calibration, HEAD/Range support and the host
+limiters are reset before every iteration unless --warm is given.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_host import MockInfinityFreeHost  # noqa: E402
+
+DOMAIN = 'bench.example.com'
+EMPTY_DOMAIN = 'empty.example.com'  # Same host behavior, nothing uploaded
+SOFT_404_DOMAIN = 'landing.example.com'  # Nothing uploaded, 200 landing page for every path
+
+# name -> (kind, target)
+SCENARIOS = {
+    'recover-htdocs': ('extract', f'https://{DOMAIN}/about.html'),          # Found by direct access under /htdocs
+    'recover-renamed': ('extract', f'https://{DOMAIN}/contact.html'),       # Only /htdocs/contact.php exists (traversal's index page outranks it)
+    'recover-missing': ('extract', f'https://{EMPTY_DOMAIN}/nothing.html'), # Every candidate fails
+    'recover-soft404': ('extract', f'https://{SOFT_404_DOMAIN}/nothing.html'),  # Every candidate is a soft 404
+    'recover-large': ('api', '/api/recover?url=https://{domain}/large.html'),
+    'recover-missing-budget': ('api', f'/api/recover?url=https://{EMPTY_DOMAIN}/nothing.html&max_requests=100'),
+    'find-files': ('api', '/api/find-files?url=https://{domain}/'),
+    'find-files-full': ('api', '/api/find-files?url=https://{domain}/&full=1'),
+    'analyze-structure': ('api', '/api/analyze-structure?url=https://{domain}/'),
+    'analyze-structure-full': ('api', '/api/analyze-structure?url=https://{domain}/&full=1'),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="Comma-separated scenarios (default: all)")
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--warm', action='store_true', help="Keep caches and learned layout between iterations")
+    parser.add_argument('--concurrency', type=int, help="PROBE_CONCURRENCY")
+    parser.add_argument('--per-host', type=int, help="PROBE_PER_HOST")
+    parser.add_argument('--host-rate', type=float, help="HOST_MAX_RATE (requests per second per host)")
+    parser.add_argument('--max-connections', type=int, help="HTTP_MAX_CONNECTIONS")
+    parser.add_argument('--strategy-weights', help="STRATEGY_WEIGHTS, e.g. direct=1,brute_force=2")
+    parser.add_argument('--slow-delay', type=float, default=0.2, help="Seconds a slow path takes")
+    parser.add_argument('--timeout-delay', type=float, default=0.05, help="Seconds before a timing-out path fails")
+    parser.add_argument('--large-size', type=int, default=5 * 1024 * 1024, help="Bytes in the large file")
+    parser.add_argument('--no-memory', action='store_true', help="Skip tracemalloc (it slows everything down)")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def configure(args):
+    """Settings are read at import time, so they go into the environment first"""
+    settings = {
+        'PROBE_CONCURRENCY': args.concurrency,
+        'PROBE_PER_HOST': args.per_host,
+        'HOST_MAX_RATE': args.host_rate,
+        'HTTP_MAX_CONNECTIONS': args.max_connections,
+        'STRATEGY_WEIGHTS': args.strategy_weights,
+    }
+    for name, value in settings.items():
+        if value is not None:
+            os.environ[name] = str(value)
+    os.environ['CACHE_BACKEND'] = 'memory'
+    os.environ['PATH_INDEX_PATH'] = ''  # Never read or write the real index
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def reset(index):
+    index.result_cache.backend.clear()
+    index.path_index._domains.clear()
+    index.probe_scheduler.limiters.clear()
+    index.header_negotiator = index.HeaderNegotiator()
+    index.soft_404_detector = index.Soft404Detector()
+    index.probe_methods = index.ProbeMethods()
+
+
+async def run_once(index, client, kind, target):
+    if kind == 'extract':
+        content, _ = await index.file_accessor.extract_uploaded_file(target)
+        return {'found': bool(content), 'bytes': len(content or '')}
+    size = 0
+    async with client.stream('GET', target.format(domain=DOMAIN)) as response:
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+    return {'status': response.status_code, 'bytes': size}
+
+
+async def run_scenario(index, host, client, name, args):
+    kind, target = SCENARIOS[name]
+    host.reset()
+    latencies = []
+    outcomes = []
+    if not args.no_memory:
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    for _ in range(args.iterations):
+        if not args.warm:
+            reset(index)
+        iteration_started = time.perf_counter()
+        outcomes.append(await run_once(index, client, kind, target))
+        latencies.append(time.perf_counter() - iteration_started)
+    wall = time.perf_counter() - started
+    return {
+        'scenario': name,
+        'iterations': args.iterations,
+        'requests': host.requests,
+        'requests_per_run': round(host.requests / args.iterations, 1),
+        'requests_by_kind': dict(host.by_kind),
+        'kib_per_run': round(host.bytes_sent / 1024 / args.iterations, 1),
+        'wall_s': round(wall, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'peak_memory_mib': None if args.no_memory else round(tracemalloc.get_traced_memory()[1] / 2**20, 2),
+        'outcome': outcomes[-1],
+    }
+
+
+async def main(args):
+    configure(args)
+    from api import index
+
+    host = MockInfinityFreeHost(DOMAIN, slow_delay=args.slow_delay, timeout_delay=args.timeout_delay,
+                                large_size=args.large_size, soft_404_hosts=[SOFT_404_DOMAIN])
+    index.http_pool.transport = host.transport()
+    if not args.no_memory:
+        tracemalloc.start()
+
+    import httpx
+    results = []
+    try:
+        transport = httpx.ASGITransport(app=index.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            for name in args.scenarios.split(','):
+                results.append(await run_scenario(index, host, client, name, args))
+    finally:
+        await index.http_pool.close()
+
+    settings = {
+        'concurrency': index.PROBE_CONCURRENCY,
+        'per_host': index.PROBE_PER_HOST,
+        'host_rate': index.HOST_MAX_RATE,
+        'max_connections': index.HTTP_MAX_CONNECTIONS,
+        'strategy_weights': index.STRATEGY_WEIGHTS,
+        'warm': args.warm,
+    }
+    return settings, results
+
+
+def report(settings, results):
+    print("Settings: " + ', '.join(f"{key}={value}" for key, value in settings.items()))
+    header = (f"{'scenario':<24} {'runs':>5} {'requests':>9} {'req/run':>8} {'KiB/run':>9} {'wall s':>8} "
+              f"{'p50 ms':>9} {'p99 ms':>9} {'peak MiB':>9}  outcome")
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        peak = '-' if result['peak_memory_mib'] is None else f"{result['peak_memory_mib']:.2f}"
+        print(
+            f"{result['scenario']:<24} {result['iterations']:>5} {result['requests']:>9} "
+            f"{result['requests_per_run']:>8} {result['kib_per_run']:>9} {result['wall_s']:>8.2f} {result['p50_ms']:>9.1f} "
+            f"{result['p99_ms']:>9.1f} {peak:>9}  {json.dumps(result['outcome'])}"
+        )
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    settings, results = asyncio.run(main(args))
+    if args.json:
+        print(json.dumps({'settings': settings, 'results': results}, indent=2))
+    else:
+        report(settings, results)